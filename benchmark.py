@@ -0,0 +1,158 @@
+"""
+Offline benchmark for moneymoney_update_category.py.
+
+Replaces the MoneyMoney export with a synthetic plist, the AI with the deterministic fake provider and the
+MoneyMoney update with a recording stub, so the pipeline can be measured on any machine (no macOS, no API key).
+
+Run with `python3 benchmark.py` or e.g. `python3 benchmark.py --sizes 100 1000 --latency 0.05`.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import plistlib
+import random
+import time
+import tracemalloc
+
+import moneymoney_update_category as mm
+
+MERCHANTS = [
+    ("REWE Markt", "Kartenzahlung"), ("Amazon EU", "Bestellung"), ("Deutsche Bahn", "Fahrkarte"),
+    ("Stadtwerke", "Abschlag Strom"), ("Allianz Versicherung", "Beitrag"), ("Netflix", "Abo"),
+    ("Shell Tankstelle", "Kartenzahlung"), ("Apotheke am Markt", "Kartenzahlung"), ("Finanzamt", "Steuer"),
+    ("Fressnapf", "Tierbedarf"), ("Vermieter GmbH", "Miete"), ("Lufthansa", "Flug"),
+]
+
+def generate_export_plist(count, seed=0):
+    """
+    Builds a MoneyMoney-style plist export with `count` transactions. A third of the transactions get a
+    unique merchant name so that caches and deduplication see a realistic mix of repeat and new payees.
+    """
+    rng = random.Random(seed)
+    today = datetime.datetime.now().replace(microsecond=0)
+    transactions = []
+    for trx_id in range(1, count + 1):
+        name, purpose = rng.choice(MERCHANTS)
+        if rng.random() < 0.33:
+            name = f"{name} {rng.randrange(10 ** 6)}"
+        transactions.append({
+            "id": trx_id,
+            "name": name,
+            "purpose": f"{purpose} {rng.randrange(10 ** 8)} {today:%d.%m.%Y}",
+            "amount": round(rng.uniform(-500, 50), 2),
+            "currency": "EUR",
+            "booked": rng.random() < 0.95,
+            "bookingDate": today - datetime.timedelta(days=rng.randrange(mm.DAYS_TO_EXPORT)),
+            "category": "",
+        })
+    return plistlib.dumps({"creator": "benchmark", "transactions": transactions}, fmt=plistlib.FMT_XML)
+
+class StageTimer:
+    """
+    Accumulates wall-clock time and call counts per pipeline stage.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+                self.calls[stage] = self.calls.get(stage, 0) + 1
+        return timed
+
+    def wrap_iterator(self, stage, iterable):
+        """
+        Times each step of a lazy iterator, e.g. the streaming plist parser.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+            yield item
+
+def run_benchmark(size, latency, measure_memory=True):
+    """
+    Runs the full pipeline once over `size` synthetic transactions and returns its measurements.
+    """
+    plist_bytes = generate_export_plist(size)
+    recorded_updates = {}
+    timer = StageTimer()
+
+    def fake_export(category_uuid, from_date=None):
+        return timer.wrap_iterator("parse", mm.iter_plist_transactions(io.BytesIO(plist_bytes)))
+
+    def recording_update(updates, chunk_size=mm.UPDATE_CHUNK_SIZE, category_uuids=None):
+        recorded_updates.update(updates)
+        return {trx_id: True for trx_id in updates}
+
+    originals = {
+        "export_transactions_from_moneymoney": mm.export_transactions_from_moneymoney,
+        "get_ai_categories_chunked": mm.get_ai_categories_chunked,
+        "update_transactions_in_moneymoney_bulk": mm.update_transactions_in_moneymoney_bulk,
+    }
+    mm.export_transactions_from_moneymoney = timer.wrap("export", fake_export)
+    mm.get_ai_categories_chunked = timer.wrap("categorize", originals["get_ai_categories_chunked"])
+    mm.update_transactions_in_moneymoney_bulk = timer.wrap("update", recording_update)
+
+    mm.METRICS.reset()
+    cache = mm.CategoryCache(path=":memory:")
+    run_state = {"last_booking_date": None, "processed_ids": {}}
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            mm.run(mm.FakeProvider(latency=latency), cache, run_state)
+    finally:
+        elapsed = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1] if measure_memory else None
+        if measure_memory:
+            tracemalloc.stop()
+        cache.close()
+        for name, function in originals.items():
+            setattr(mm, name, function)
+
+    return {
+        "size": size,
+        "elapsed": elapsed,
+        "throughput": size / elapsed if elapsed else 0.0,
+        "stages": dict(timer.seconds),
+        "updated": len(recorded_updates),
+        "cache_hit_rate": cache.hit_rate,
+        "peak_bytes": peak_bytes,
+    }
+
+def print_report(results):
+    stages = sorted({stage for result in results for stage in result["stages"]})
+    header = f"{'size':>8} {'total s':>9} {'trx/s':>10} " + " ".join(f"{stage + ' s':>12}" for stage in stages) + f" {'cache hit':>10} {'peak MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        stage_columns = " ".join(f"{result['stages'].get(stage, 0.0):>12.3f}" for stage in stages)
+        peak = f"{result['peak_bytes'] / 1e6:>9.1f}" if result["peak_bytes"] is not None else f"{'n/a':>9}"
+        print(f"{result['size']:>8} {result['elapsed']:>9.3f} {result['throughput']:>10.0f} {stage_columns} {result['cache_hit_rate']:>10.0%} {peak}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for the categorization pipeline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000], help="Number of transactions per run.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated AI latency per request in seconds.")
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc, which slows down the run.")
+    args = parser.parse_args()
+
+    results = [run_benchmark(size, args.latency, measure_memory=not args.no_memory) for size in args.sizes]
+    print_report(results)
+
+if __name__ == "__main__":
+    main()
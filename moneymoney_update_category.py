@@ -3,15 +3,42 @@ import plistlib
 import os
 import datetime
 import json
-from openai import OpenAI
+import argparse
+import base64
+import tempfile
+from xml.etree import ElementTree
+import asyncio
+import zlib
+import itertools
+import collections
+import random
+import email.utils
+import threading
+import contextlib
+import queue
+import re
+import sqlite3
+import time
+import cProfile
+import pstats
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from openai import OpenAI, AsyncOpenAI, APIConnectionError as OpenAIConnectionError
 import anthropic
+try:
+    import numpy  # Optional: enables the nearest-neighbor classifier.
+except ImportError:
+    numpy = None
+try:
+    import tiktoken  # Optional: exact token counts in the prompt size report.
+except ImportError:
+    tiktoken = None
 # The 'deepseek' library is used by the OpenAI client via the base_url, so no direct import is needed.
 from pathlib import Path
 
 
 # --- CONFIGURATION ---
 # ❗ CHOOSE YOUR AI PROVIDER HERE
-# Options: "openai", "anthropic", "deepseek"
+# Options: "openai", "anthropic", "deepseek" (or "fake" for offline testing)
 AI_PROVIDER = "deepseek" 
 
 # Replace with the UUID for your "Uncategorized" category in MoneyMoney.
@@ -20,53 +47,930 @@ UNCATGEGORIZED_CATEGORY_UUID = "a2fea395-d50a-41f9-913a-4a73dec89e72"
 # The number of days back to look for transactions.
 DAYS_TO_EXPORT = 20 #90
 
+# Export fan-out: one export per account in EXPORT_ACCOUNTS (account numbers, IBANs or names; empty = all
+# accounts) and per category, i.e. the uncategorized category plus any category UUIDs in EXPORT_CATEGORIES
+# whose transactions should be re-examined. Up to EXPORT_CONCURRENCY exports run at once (MoneyMoney is a
+# single app, so keep this small); their transactions are merged and deduplicated by id.
+EXPORT_ACCOUNTS = []
+EXPORT_CATEGORIES = []
+EXPORT_CONCURRENCY = 2
+
+# Long export windows are split into EXPORT_SLICE_DAYS slices (0 = one export for the whole window), which are
+# exported independently and categorized as soon as each arrives. Failing exports are retried EXPORT_MAX_RETRIES
+# times, waiting EXPORT_RETRY_DELAY seconds and doubling the wait for every further attempt.
+EXPORT_SLICE_DAYS = 31
+EXPORT_MAX_RETRIES = 2
+EXPORT_RETRY_DELAY = 5.0
+
+# How batches are written into the prompt: "compact" (one TSV line per transaction, short per-batch ids and
+# numbered categories) or "json" (the original indented JSON with full transaction ids and category names).
+PROMPT_FORMAT = "compact"
+# "structured" constrains the answer to a JSON schema with the categories as an enum (OpenAI json_schema
+# structured outputs, Anthropic tool use); "json" only asks for a JSON object. DeepSeek always uses "json".
+AI_OUTPUT_MODE = "structured"
+
+# Stream AI answers and hand each categorized transaction to the MoneyMoney updater as soon as it is complete.
+AI_STREAMING = True
+
+# Prints prompt tokens per transaction in both formats after categorization (uses tiktoken if installed).
+# Off by default: it encodes and tokenizes every batch twice more on the thread that dispatches the batches.
+REPORT_PROMPT_TOKENS = False
+
+# How many transactions are sent to the AI provider per request, and how many requests may be in flight at once.
+AI_BATCH_SIZE = 50
+AI_MAX_CONCURRENCY = 4
+
+# Adaptive batch sizing: starting from AI_BATCH_SIZE, batches grow by AI_BATCH_SIZE_STEP while requests finish
+# within AI_TARGET_LATENCY seconds and halve after truncated answers, errors or slow requests.
+AI_ADAPTIVE_BATCH_SIZE = True
+AI_MIN_BATCH_SIZE = 5
+AI_MAX_BATCH_SIZE = 250
+AI_BATCH_SIZE_STEP = 10
+AI_TARGET_LATENCY = 30.0
+
+# Failed AI requests are retried with jittered exponential backoff (or as long as the provider's Retry-After asks).
+AI_MAX_RETRIES = 5
+AI_RETRY_BASE_DELAY = 1.0
+AI_RETRY_MAX_DELAY = 60.0
+# Transactions missing from an answer (or given an invalid category) are re-queried up to this many times.
+AI_REQUERY_ROUNDS = 2
+
+# Deterministic rules (salary, rent, utilities, ...) applied before the cache and the AI.
+# See category_rules.example.json for the format; no rules are applied if the file does not exist.
+RULES_PATH = Path(__file__).with_name("category_rules.json")
+
+# Local cache of merchant -> category decisions, so recurring payees skip the AI call.
+CACHE_PATH = Path.home() / ".moneymoney_ai_categories.sqlite"
+CACHE_TTL_DAYS = 180
+
+# Nearest-neighbor first pass: transactions whose name/purpose closely resembles an already categorized one
+# (cosine similarity of hashed character trigrams) take its category without an AI call. Requires NumPy.
+NN_ENABLED = True
+NN_SIMILARITY_THRESHOLD = 0.9
+NN_EMBEDDING_DIM = 1024
+NN_BATCH_SIZE = 256
+
+# History export (`--export-history`): categorized transactions of the last HISTORY_DAYS are exported in
+# HISTORY_SLICE_DAYS chunks and saved as a NumPy snapshot that seeds the cache and the nearest-neighbor classifier.
+HISTORY_PATH = Path.home() / ".moneymoney_ai_history.npz"
+HISTORY_DAYS = 730
+HISTORY_SLICE_DAYS = 90
+
+# Incremental runs: the last processed booking date and transaction IDs are remembered here, and the next
+# run only exports from that date (minus a small overlap for late-booked transactions).
+STATE_PATH = Path.home() / ".moneymoney_ai_categories_state.json"
+INCREMENTAL_OVERLAP_DAYS = 3
+
+# Write-ahead journal of the current run: every AI batch result and every applied update is appended (and synced
+# to disk) as it happens. If a run dies, the next one reuses the journaled AI answers and skips the transactions
+# already written, instead of paying for the same AI calls again. The journal is emptied after a completed run.
+JOURNAL_PATH = Path.home() / ".moneymoney_ai_journal.jsonl"
+
+# How many category updates are sent to MoneyMoney in a single AppleScript run. Updates are written in the
+# background while categorization continues; a partial chunk is written after UPDATE_FLUSH_INTERVAL idle seconds.
+UPDATE_CHUNK_SIZE = 200
+UPDATE_FLUSH_INTERVAL = 2.0
+
+# Bounded queues between the pipeline stages (export -> categorize -> update). When a later stage falls
+# behind, the earlier ones block instead of buffering without limit.
+PIPELINE_QUEUE_SIZE = 500
+UPDATE_QUEUE_SIZE = 1000
+
+# Machine-readable metrics of each run (durations, token counts, latency percentiles, hit rates), e.g. for cron.
+# METRICS_FORMAT "jsonl" appends to METRICS_PATH, "prometheus" rewrites it for node_exporter's textfile collector.
+# Set METRICS_PATH to None to disable.
+METRICS_PATH = Path.home() / ".moneymoney_ai_metrics.jsonl"
+METRICS_FORMAT = "jsonl"
+
+# Category tree: MoneyMoney's categories are exported once and cached in CATEGORY_TREE_PATH, so updates target
+# category UUIDs and the prompt lists the real categories. The tree is exported again after CATEGORY_TREE_TTL_HOURS,
+# with --refresh-categories, or after a run with failed updates. Without it, AVAILABLE_CATEGORIES below is used.
+CATEGORY_TREE_PATH = Path.home() / ".moneymoney_ai_category_tree.json"
+CATEGORY_TREE_TTL_HOURS = 24
+
 AVAILABLE_CATEGORIES = ["Uncategorized","Auto","Family","Health & Personal Care","Household & Home","Leisure & Entertainment","Miscellaneous","Pets","Shopping","Tax","Travel & Transportation","AVC","Pension","Real Estate","Rental Income", "Savings", "Online Services", "Deposit", "Insurance", "Business Expenses", "Utilities", "Investments"]
 
-# --- Main Functions ---
+# --- Rule Engine ---
 
-def export_transactions_from_moneymoney(category_uuid):
+class _KeywordAutomaton:
     """
-    Executes an AppleScript to export all transactions from a specific category UUID AND a date range.
+    Aho-Corasick automaton: finds all occurrences of many keywords in a single pass over the text.
     """
-    print(f"👉 Step 1: Exporting transactions from category '{category_uuid}' for the last {DAYS_TO_EXPORT} days...")
-    
-    from_date = datetime.date.today() - datetime.timedelta(days=DAYS_TO_EXPORT)
-    from_date_str = from_date.strftime('%Y-%m-%d')
 
-    applescript_code = f'tell application "MoneyMoney" to export transactions from category "{category_uuid}" from date "{from_date_str}" as "plist"'
-    command = ['osascript', '-e', applescript_code]
-    
+    def __init__(self):
+        self.transitions = [{}]
+        self.failure = [0]
+        self.outputs = [[]]
+
+    def add(self, keyword, value):
+        state = 0
+        for char in keyword:
+            if char not in self.transitions[state]:
+                self.transitions.append({})
+                self.failure.append(0)
+                self.outputs.append([])
+                self.transitions[state][char] = len(self.transitions) - 1
+            state = self.transitions[state][char]
+        self.outputs[state].append((len(keyword), value))
+
+    def build(self):
+        # Breadth-first, so every failure link points to an already finished, shallower state.
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fallback = self.failure[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.failure[fallback]
+                self.failure[next_state] = self.transitions[fallback].get(char, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.failure[next_state]]
+
+    def search(self, text):
+        """
+        Yields (start, end, value) for every keyword occurrence in `text`.
+        """
+        state = 0
+        for end, char in enumerate(text, start=1):
+            while state and char not in self.transitions[state]:
+                state = self.failure[state]
+            state = self.transitions[state].get(char, 0)
+            for length, value in self.outputs[state]:
+                yield end - length, end, value
+
+class RuleEngine:
+    """
+    Deterministic category rules, evaluated before any AI call. Each rule has a `category`, one
+    case-insensitive regular expression in `name`, `purpose` or `pattern` (searched in both), and
+    optionally `min_amount` / `max_amount`. The first matching rule in file order wins.
+
+    Rules whose pattern is a plain word or a `|`-list of plain words go into one Aho-Corasick automaton,
+    so any number of them is matched in a single pass over the text. All other patterns are compiled on
+    their own and searched in their field only, and only up to the first rule the automaton matched.
+    """
+    FIELDS = ("name", "purpose", "pattern")
+    REGEX_METACHARACTERS = set(".^$*+?{}[]\\()")
+
+    def __init__(self, rules):
+        self.rules = []
+        self.rule_fields = []
+        self.automaton = _KeywordAutomaton()
+        self.regexes = {}
+        for index, rule in enumerate(rules):
+            fields = [field for field in self.FIELDS if rule.get(field)]
+            if not rule.get("category") or len(fields) != 1:
+                raise ValueError(f"Rule {index + 1} needs a 'category' and exactly one of 'name', 'purpose' or 'pattern': {rule}")
+            field, pattern = fields[0], rule[fields[0]]
+            self.rules.append(rule)
+            self.rule_fields.append(field)
+
+            if not self.REGEX_METACHARACTERS & set(pattern):
+                for keyword in pattern.lower().split("|"):
+                    if keyword:
+                        self.automaton.add(keyword, index)
+            else:
+                try:
+                    self.regexes[index] = re.compile(pattern, re.IGNORECASE)
+                except re.error as e:
+                    raise ValueError(f"Rule {index + 1} has an invalid pattern {pattern!r}: {e}")
+        self.automaton.build()
+
+    def __len__(self):
+        return len(self.rules)
+
+    @staticmethod
+    def _amount_matches(rule, amount):
+        if "min_amount" in rule and (amount is None or amount < rule["min_amount"]):
+            return False
+        if "max_amount" in rule and (amount is None or amount > rule["max_amount"]):
+            return False
+        return True
+
+    def _keyword_matches(self, name, purpose):
+        """
+        Returns the sorted indices of keyword rules that occur in their field.
+        """
+        matches = set()
+        for field, text in (("name", name), ("purpose", purpose)):
+            for _, _, index in self.automaton.search(text.lower()):
+                if self.rule_fields[index] in (field, "pattern"):
+                    matches.add(index)
+        return sorted(matches)
+
+    def _regex_matches(self, index, name, purpose):
+        regex = self.regexes[index]
+        field = self.rule_fields[index]
+        return ((field != "purpose" and regex.search(name) is not None)
+                or (field != "name" and regex.search(purpose) is not None))
+
+    def match(self, trx):
+        """
+        Returns the category of the first rule matching the transaction, or None.
+        """
+        name = trx.get('name') or ''
+        purpose = trx.get('purpose') or ''
+        amount = trx.get("amount")
+        first_keyword_rule = next(
+            (index for index in self._keyword_matches(name, purpose) if self._amount_matches(self.rules[index], amount)), None)
+        # Regex rules only need checking if they come before the first matching keyword rule.
+        for index in self.regexes:
+            if first_keyword_rule is not None and index > first_keyword_rule:
+                break
+            if self._amount_matches(self.rules[index], amount) and self._regex_matches(index, name, purpose):
+                return self.rules[index]["category"]
+        return self.rules[first_keyword_rule]["category"] if first_keyword_rule is not None else None
+
+def load_rules(path=RULES_PATH):
+    """
+    Loads the rule file if it exists. Returns a RuleEngine, or None if there is no rule file.
+    """
+    if not Path(path).exists():
+        return None
+    with open(path) as f:
+        engine = RuleEngine(json.load(f))
+    unknown = sorted({rule["category"] for rule in engine.rules} - set(AVAILABLE_CATEGORIES))
+    if unknown:
+        print(f"⚠️ WARNING: Rules use categories that are not in AVAILABLE_CATEGORIES: {unknown}")
+    print(f"📏 Loaded {len(engine)} category rules from {path}.")
+    return engine
+
+# --- Category Tree ---
+
+class CategoryTree:
+    """
+    MoneyMoney's categories as exported by `export categories`: a list of dicts with name, path, uuid and
+    group (category groups cannot hold transactions). Categories are offered to the AI by name, or by path
+    where a name occurs more than once; the uncategorized category is always offered as "Uncategorized".
+    """
+
+    def __init__(self, categories, exported_at=None):
+        self.categories = categories
+        self.exported_at = exported_at or time.time()
+        self.uncategorized_uuid = next((category["uuid"] for category in categories if category.get("default")), UNCATGEGORIZED_CATEGORY_UUID)
+
+        leaves = [category for category in categories if not category["group"] and category["uuid"] != self.uncategorized_uuid]
+        name_counts = collections.Counter(category["name"] for category in leaves)
+        self.uuids = {"Uncategorized": self.uncategorized_uuid}
+        for category in leaves:
+            self.uuids[category["name"] if name_counts[category["name"]] == 1 else category["path"]] = category["uuid"]
+
+    @classmethod
+    def from_export(cls, entries):
+        """
+        Builds the tree from the exported plist entries, deriving each category's path from its indentation.
+        """
+        categories = []
+        parents = []
+        for entry in entries:
+            indentation = int(entry.get("indentation", 0))
+            del parents[indentation:]
+            path = "\\".join(parents + [entry["name"]])
+            categories.append({
+                "name": entry["name"],
+                "path": path,
+                "uuid": entry["uuid"],
+                "group": bool(entry.get("group")),
+                "default": bool(entry.get("default")),
+            })
+            parents.append(entry["name"])
+        return cls(categories)
+
+    def names(self):
+        """
+        Category labels for the prompt, "Uncategorized" first.
+        """
+        return list(self.uuids)
+
+    def age_hours(self):
+        return (time.time() - self.exported_at) / 3600
+
+def export_category_tree_from_moneymoney():
+    """
+    Exports MoneyMoney's category tree. Returns a CategoryTree, or None if the export failed.
+    """
+    print("👉 Exporting the category tree from MoneyMoney...")
     try:
-        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as pipe:
-            stdout, stderr = pipe.communicate()
-            if pipe.returncode != 0:
-                print(f"❌ ERROR: Failed to export transactions. Error: {stderr.decode().strip()}")
-                return None
-            if not stdout:
-                print("❌ ERROR: Export returned no data. Check if there are transactions in this category within the date range.")
-                return None
-            parsed_data = plistlib.loads(stdout)
-            print(f"✅ Transactions successfully exported and captured.")
-            return parsed_data
-    except Exception as e:
-        print(f"❌ ERROR: An unexpected error occurred during export. Error: {e}")
+        completed = subprocess.run(['osascript', '-e', 'tell application "MoneyMoney" to export categories'], check=True, capture_output=True)
+        exported = plistlib.loads(completed.stdout)
+    except (OSError, subprocess.CalledProcessError, plistlib.InvalidFileException) as e:
+        print(f"⚠️ WARNING: Could not export the category tree, using AVAILABLE_CATEGORIES. Error: {e}")
         return None
+    entries = exported.get("categories", []) if isinstance(exported, dict) else exported
+    return CategoryTree.from_export(entries)
 
-def get_ai_categories_batch(client, provider, transactions_to_process):
+def load_category_tree(path=CATEGORY_TREE_PATH, ttl_hours=CATEGORY_TREE_TTL_HOURS, refresh=False):
     """
-    Sends a batch of transactions to the selected AI provider.
+    Returns the cached category tree, exporting it from MoneyMoney again if it is missing, older than
+    `ttl_hours` or `refresh` is set. Falls back to a stale cache, and to None, if the export fails.
     """
-    print(f"Formatting batch for AI provider: {provider}...")
-    input_json_list = []
-    for trx in transactions_to_process:
-        purpose = trx.get("purpose", "")
-        recipient = trx.get("name", "")
-        detail_for_ai = f"{recipient} - {purpose}"
-        input_json_list.append({"id": trx["id"], "detail": detail_for_ai})
-    
-    input_json_string = json.dumps(input_json_list, indent=2)
+    cached = None
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        cached = CategoryTree(data["categories"], data["exported_at"])
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        print(f"⚠️ WARNING: Could not read the cached category tree from {path}. Error: {e}")
+
+    if cached and not refresh and cached.age_hours() < ttl_hours:
+        return cached
+    tree = export_category_tree_from_moneymoney()
+    if tree is None:
+        return cached
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"exported_at": tree.exported_at, "categories": tree.categories}, f)
+    os.replace(temp_path, path)
+    print(f"✅ Cached {len(tree.categories)} categories in {path}.")
+    return tree
+
+def invalidate_category_tree(path=CATEGORY_TREE_PATH):
+    """
+    Deletes the cached tree so the next run exports it again, e.g. after updates to a deleted category failed.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# --- Category Cache ---
+
+def transaction_fingerprint(trx):
+    """
+    Builds a normalized key from a transaction's name and purpose. Digits and punctuation are dropped so that
+    recurring payments with changing dates or reference numbers map to the same key.
+    """
+    def normalize(text):
+        text = re.sub(r"[\d\W_]+", " ", str(text or "").lower())
+        return " ".join(text.split())
+    return f"{normalize(trx.get('name'))}|{normalize(trx.get('purpose'))}"
+
+class CategoryCache:
+    """
+    SQLite-backed store of the last category assigned to each transaction fingerprint.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl_days=CACHE_TTL_DAYS):
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS category_cache (
+                fingerprint TEXT PRIMARY KEY,
+                category TEXT NOT NULL,
+                hit_count INTEGER NOT NULL DEFAULT 1,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self.connection.commit()
+
+    def lookup(self, fingerprint):
+        """
+        Returns the cached category for a transaction fingerprint, or None if it is unknown or expired.
+        """
+        row = self.connection.execute(
+            "SELECT category, updated_at FROM category_cache WHERE fingerprint = ?",
+            (fingerprint,),
+        ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl_seconds:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def store(self, fingerprint, category):
+        """
+        Records the category for a transaction fingerprint. Repeating the same category raises its hit count,
+        a different category replaces it and starts counting again.
+        """
+        self.connection.execute("""
+            INSERT INTO category_cache (fingerprint, category, hit_count, updated_at) VALUES (?, ?, 1, ?)
+            ON CONFLICT(fingerprint) DO UPDATE SET
+                hit_count = CASE WHEN category = excluded.category THEN hit_count + 1 ELSE 1 END,
+                category = excluded.category,
+                updated_at = excluded.updated_at
+        """, (fingerprint, category, time.time()))
+
+    def entries(self):
+        """
+        Returns (fingerprint, category) pairs for all entries that have not expired.
+        """
+        return self.connection.execute(
+            "SELECT fingerprint, category FROM category_cache WHERE updated_at >= ?",
+            (time.time() - self.ttl_seconds,),
+        ).fetchall()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+# --- Nearest-Neighbor Classifier ---
+
+def embed_texts(texts, dim=NN_EMBEDDING_DIM):
+    """
+    Embeds texts as L2-normalized bags of hashed character trigrams in a (len(texts), dim) float32 matrix.
+    """
+    rows, columns = [], []
+    for row, text in enumerate(texts):
+        padded = f"  {text} "
+        for start in range(len(padded) - 2):
+            rows.append(row)
+            columns.append(zlib.crc32(padded[start:start + 3].encode("utf-8")) % dim)
+    vectors = numpy.zeros((len(texts), dim), dtype=numpy.float32)
+    numpy.add.at(vectors, (numpy.array(rows, dtype=numpy.intp), numpy.array(columns, dtype=numpy.intp)), 1.0)
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / numpy.maximum(norms, 1e-12)
+
+class NearestNeighborClassifier:
+    """
+    Assigns a new transaction the category of its most similar previously categorized transaction,
+    if the cosine similarity of their fingerprints is at least `threshold`.
+    """
+
+    def __init__(self, texts, categories, threshold=NN_SIMILARITY_THRESHOLD, vectors=None):
+        self.threshold = threshold
+        self.categories = list(categories)
+        self.vectors = vectors if vectors is not None else embed_texts(texts)
+
+    def __len__(self):
+        return len(self.categories)
+
+    def predict(self, texts):
+        """
+        Returns a list of (category, similarity) pairs, with category None where no neighbor is close enough.
+        """
+        if not texts:
+            return []
+        similarities = embed_texts(texts) @ self.vectors.T
+        best = similarities.argmax(axis=1)
+        scores = similarities[numpy.arange(len(texts)), best]
+        return [
+            (self.categories[index] if score >= self.threshold else None, float(score))
+            for index, score in zip(best, scores)
+        ]
+
+def build_classifier(category_cache, history=None):
+    """
+    Builds a nearest-neighbor index over the categorized fingerprints in the cache and, if given, those of a
+    history snapshot from `load_history_snapshot` that the cache does not know. Returns None if the classifier is disabled, NumPy is missing or
+    there is nothing to learn from.
+    """
+    if not NN_ENABLED:
+        return None
+    if numpy is None:
+        print("⚠️ WARNING: NumPy is not installed, skipping the nearest-neighbor classifier.")
+        return None
+    entries = category_cache.entries()
+    fingerprints = [fingerprint for fingerprint, _ in entries]
+    categories = [category for _, category in entries]
+    vectors = embed_texts(fingerprints)
+    if history is not None and len(history["ids"]):
+        # export_history also seeds the cache, and payees repeat across history rows: index every fingerprint
+        # once, with the cache's category if it has one and otherwise the one of its latest history row.
+        cached_fingerprints = set(fingerprints)
+        latest_rows = {}
+        for row in numpy.argsort(history["booking_dates"], kind="stable"):
+            fingerprint = str(history["fingerprints"][row])
+            if fingerprint not in cached_fingerprints:
+                latest_rows[fingerprint] = row
+        rows = numpy.array(list(latest_rows.values()), dtype=numpy.int64)
+        if len(rows):
+            categories += [str(category) for category in history["category_names"][history["category_codes"][rows]]]
+            vectors = numpy.concatenate([vectors, history["vectors"][rows]])
+    if not categories:
+        return None
+    classifier = NearestNeighborClassifier(None, categories, vectors=vectors)
+    print(f"🧭 Nearest-neighbor classifier indexed {len(classifier)} categorized transactions.")
+    return classifier
+
+# --- History Snapshot ---
+
+def save_history_snapshot(records, path=HISTORY_PATH):
+    """
+    Stores categorized transactions as columnar NumPy arrays (ids, booking dates, fingerprints, category codes
+    and their precomputed embeddings) so that they reload in milliseconds. `records` is a list of
+    (transaction_id, booking_date, fingerprint, category) tuples.
+    """
+    ids, booking_dates, fingerprints, categories = zip(*records) if records else ((), (), (), ())
+    category_names = sorted(set(categories))
+    category_codes = {category: code for code, category in enumerate(category_names)}
+    temp_path = f"{path}.tmp.npz"
+    numpy.savez(
+        temp_path,
+        ids=numpy.array(ids, dtype=numpy.int64),
+        booking_dates=numpy.array(booking_dates, dtype="datetime64[D]"),
+        fingerprints=numpy.array(fingerprints, dtype=str),
+        category_codes=numpy.array([category_codes[category] for category in categories], dtype=numpy.int32),
+        category_names=numpy.array(category_names, dtype=str),
+        vectors=embed_texts(fingerprints),
+    )
+    os.replace(temp_path, path)
+
+def load_history_snapshot(path=HISTORY_PATH):
+    """
+    Loads a snapshot written by `save_history_snapshot` as a dict of arrays, or returns None if there is none.
+    """
+    if numpy is None or not Path(path).exists():
+        return None
+    start = time.perf_counter()
+    with numpy.load(path, allow_pickle=False) as snapshot:
+        history = {key: snapshot[key] for key in snapshot.files}
+    if history["vectors"].shape[1:] != (NN_EMBEDDING_DIM,):
+        history["vectors"] = embed_texts(list(history["fingerprints"]))
+    print(f"📚 Loaded {len(history['ids'])} categorized transactions from {path} in {(time.perf_counter() - start) * 1000:.0f} ms.")
+    return history
+
+# --- Run State ---
+
+def load_run_state(path=STATE_PATH):
+    """
+    Loads the high-water mark of the previous run. Returns empty state if there is none or it is unreadable.
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {"last_booking_date": None, "processed_ids": {}}
+    except (OSError, ValueError) as e:
+        print(f"⚠️ WARNING: Could not read run state from {path}, starting a full export. Error: {e}")
+        return {"last_booking_date": None, "processed_ids": {}}
+    state.setdefault("last_booking_date", None)
+    state.setdefault("processed_ids", {})
+    return state
+
+def save_run_state(state, path=STATE_PATH):
+    """
+    Atomically writes the run state so an interrupted write never leaves a corrupt file behind.
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(temp_path, path)
+
+def export_start_date(state):
+    """
+    Returns the date the export should start from: the stored high-water mark minus the overlap,
+    or the full DAYS_TO_EXPORT window on the first run.
+    """
+    if state.get("last_booking_date"):
+        high_water_mark = datetime.date.fromisoformat(state["last_booking_date"])
+        return high_water_mark - datetime.timedelta(days=INCREMENTAL_OVERLAP_DAYS)
+    return datetime.date.today() - datetime.timedelta(days=DAYS_TO_EXPORT)
+
+def advance_run_state(state, handled, unhandled):
+    """
+    Records the handled transactions and moves the high-water mark. `handled` and `unhandled` are lists of
+    (transaction_id, booking_date) pairs. If anything was left unhandled the mark stops at its earliest
+    booking date, so the next run exports it again. IDs older than the overlap window are pruned.
+    """
+    processed_ids = state["processed_ids"]
+    for trx_id, booking_date in handled:
+        processed_ids[str(trx_id)] = booking_date.isoformat()
+
+    if unhandled:
+        high_water_mark = min(booking_date for _, booking_date in unhandled)
+    else:
+        candidates = [booking_date for _, booking_date in handled]
+        if state.get("last_booking_date"):
+            candidates.append(datetime.date.fromisoformat(state["last_booking_date"]))
+        high_water_mark = max(candidates) if candidates else None
+
+    if high_water_mark:
+        state["last_booking_date"] = high_water_mark.isoformat()
+        cutoff = (high_water_mark - datetime.timedelta(days=INCREMENTAL_OVERLAP_DAYS)).isoformat()
+        state["processed_ids"] = {trx_id: day for trx_id, day in processed_ids.items() if day >= cutoff}
+    return state
+
+def _current_category(trx, category_tree=None):
+    """
+    The category an exported transaction is in right now. With a `category_tree` this is the category's UUID
+    (None if the export does not say), otherwise its name, with "Uncategorized" for an empty category.
+    """
+    category = trx.get("category")
+    if category_tree:
+        return trx.get("categoryUuid") or (None if category else category_tree.uncategorized_uuid)
+    if not category or trx.get("categoryUuid") == UNCATGEGORIZED_CATEGORY_UUID:
+        return "Uncategorized"
+    return category
+
+def _booking_date(trx):
+    booking_date = trx.get('bookingDate') or datetime.datetime.now()
+    return booking_date.date() if isinstance(booking_date, datetime.datetime) else booking_date
+
+# --- Run Journal ---
+
+class RunJournal:
+    """
+    Append-only JSON lines journal of a run's AI decisions and applied updates. Each record is flushed and
+    fsynced before the call returns. Opening a journal left behind by an interrupted run loads its records
+    into `decisions` and `applied` (transaction id -> category); a torn last line is cut off, so new records
+    start on a line of their own.
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.decisions = {}
+        self.applied = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            content = b""
+        complete = content[:content.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            target = self.applied if record.get("type") == "applied" else self.decisions
+            target.update((trx_id, category) for trx_id, category in record.get("categories", []))
+        self.file = open(path, "a")
+        if len(complete) < len(content):
+            self.file.truncate(len(complete))
+
+    def __bool__(self):
+        return bool(self.decisions or self.applied)
+
+    def _append(self, record_type, categories):
+        if not categories:
+            return
+        line = json.dumps({"type": record_type, "categories": [[trx_id, category] for trx_id, category in categories.items()]})
+        with self._lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def record_decisions(self, id_to_category_map):
+        """
+        Journals one AI batch's id -> category answers.
+        """
+        self._append("decisions", id_to_category_map)
+
+    def record_applied(self, id_to_category_map):
+        """
+        Journals updates that were written to MoneyMoney successfully.
+        """
+        self._append("applied", id_to_category_map)
+
+    def clear(self):
+        """
+        Empties the journal once the run is complete and its state has been saved.
+        """
+        with self._lock:
+            self.file.truncate(0)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.decisions = {}
+            self.applied = {}
+
+    def close(self):
+        self.file.close()
+
+# --- Metrics ---
+
+def _percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted, non-empty list.
+    """
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+def _prometheus_label_value(value):
+    """
+    Escapes a label value as the Prometheus text format requires.
+    """
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Metrics:
+    """
+    Collects the timings, counters and gauges of a run and writes them as JSON lines or as a Prometheus
+    textfile. Every observation (a latency, a batch's token count) is kept, so percentiles can be computed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.events = []
+            self.observations = collections.defaultdict(list)
+            self.counters = collections.defaultdict(float)
+            self.gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        # Label values are strings in both output formats, and mixed types would not sort.
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            self.observations[self._key(name, labels)].append(value)
+            self.events.append({"ts": round(time.time(), 3), "metric": name, "value": value, **labels})
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[self._key(name, labels)] += value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summaries(self):
+        """
+        Returns {(name, labels): {"count", "sum", "p50", "p90", "p99", "max"}} for all observations.
+        """
+        with self._lock:
+            observations = {key: sorted(values) for key, values in self.observations.items()}
+        return {
+            key: {
+                "count": len(values),
+                "sum": sum(values),
+                "p50": _percentile(values, 0.5),
+                "p90": _percentile(values, 0.9),
+                "p99": _percentile(values, 0.99),
+                "max": values[-1],
+            }
+            for key, values in observations.items() if values
+        }
+
+    def write(self, path=None, metrics_format=None):
+        """
+        Appends the run's events and summaries to a JSON lines file, or atomically replaces a Prometheus
+        textfile (for node_exporter's textfile collector).
+        """
+        path = path or METRICS_PATH
+        metrics_format = metrics_format or METRICS_FORMAT
+        if metrics_format == "prometheus":
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w") as f:
+                f.write(self.prometheus_text())
+            os.replace(temp_path, path)
+        elif metrics_format == "jsonl":
+            run_started = datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds")
+            with open(path, "a") as f:
+                for event in self.events:
+                    f.write(json.dumps({"run": run_started, **event}) + "\n")
+                for (name, labels), summary in self.summaries().items():
+                    f.write(json.dumps({"run": run_started, "summary": name, **dict(labels), **summary}) + "\n")
+                for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                    for (name, labels), value in values.items():
+                        f.write(json.dumps({"run": run_started, kind: name, "value": value, **dict(labels)}) + "\n")
+        else:
+            raise ValueError(f"Unknown metrics format '{metrics_format}'. Use 'jsonl' or 'prometheus'.")
+
+    def prometheus_text(self):
+        def series(name, labels, extra=()):
+            label_text = ",".join(f'{key}="{_prometheus_label_value(value)}"' for key, value in (*labels, *extra))
+            return f"moneymoney_ai_{name}{{{label_text}}}" if label_text else f"moneymoney_ai_{name}"
+
+        lines = []
+        declared = set()
+
+        def declare(name, metric_type):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE moneymoney_ai_{name} {metric_type}")
+
+        for (name, labels), summary in sorted(self.summaries().items()):
+            declare(name, "summary")
+            for quantile, key in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99")):
+                lines.append(f"{series(name, labels, [('quantile', quantile)])} {summary[key]}")
+            lines.append(f"{series(name + '_sum', labels)} {summary['sum']}")
+            lines.append(f"{series(name + '_count', labels)} {summary['count']}")
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name + "_total", "counter")
+            lines.append(f"{series(name + '_total', labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{series(name, labels)} {value}")
+        declare("last_run_timestamp_seconds", "gauge")
+        lines.append(f"{series('last_run_timestamp_seconds', ())} {self.started}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+# --- Plist Parsing ---
+
+def _plist_value(element):
+    """
+    Converts a parsed plist XML element into the Python value plistlib would return for it.
+    """
+    tag = element.tag
+    if tag == "dict":
+        children = list(element)
+        return {key.text or "": _plist_value(value) for key, value in zip(children[::2], children[1::2])}
+    if tag == "array":
+        return [_plist_value(child) for child in element]
+    if tag == "string":
+        return element.text or ""
+    if tag == "integer":
+        return int(element.text)
+    if tag == "real":
+        return float(element.text)
+    if tag == "true":
+        return True
+    if tag == "false":
+        return False
+    if tag == "date":
+        return datetime.datetime.strptime(element.text, "%Y-%m-%dT%H:%M:%SZ")
+    if tag == "data":
+        return base64.b64decode(element.text or "")
+    raise ValueError(f"Unsupported plist element <{tag}>")
 
-    system_prompt = f"""
+def iter_plist_transactions(stream):
+    """
+    Incrementally parses a MoneyMoney plist export from a binary file object and yields the entries of its
+    top-level "transactions" array one at a time. Each transaction's XML is discarded once it has been
+    converted, so memory use does not grow with the size of the export.
+    """
+    if stream.read(8).startswith(b"bplist"):
+        # Binary plists cannot be parsed incrementally.
+        stream.seek(0)
+        yield from plistlib.load(stream).get("transactions", [])
+        return
+    stream.seek(0)
+
+    stack = []
+    last_key = None
+    transactions_array = None
+    for event, element in ElementTree.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            stack.append(element)
+            if len(stack) == 3 and element.tag == "array" and last_key == "transactions":
+                transactions_array = element
+            continue
+
+        stack.pop()
+        if len(stack) == 2 and element.tag == "key":
+            last_key = element.text
+        elif transactions_array is not None and len(stack) == 3 and stack[-1] is transactions_array:
+            yield _plist_value(element)
+            transactions_array.remove(element)
+        elif element is transactions_array:
+            transactions_array = None
+
+# --- Prompt Encoding ---
+
+def count_tokens(text):
+    """
+    Counts prompt tokens with tiktoken when it is installed, otherwise estimates four characters per token.
+    """
+    if tiktoken is not None:
+        return len(_tiktoken_encoding().encode(text))
+    return max(1, len(text) // 4)
+
+def _tiktoken_encoding():
+    global _TIKTOKEN_ENCODING
+    if _TIKTOKEN_ENCODING is None:
+        _TIKTOKEN_ENCODING = tiktoken.get_encoding("o200k_base")
+    return _TIKTOKEN_ENCODING
+
+_TIKTOKEN_ENCODING = None
+
+def transaction_detail(trx):
+    """
+    Returns the single-line "recipient - purpose" text the model sees for a transaction.
+    """
+    purpose = trx.get("purpose", "")
+    recipient = trx.get("name", "")
+    return " ".join(f"{recipient} - {purpose}".split())
+
+def build_system_prompt(prompt_format=PROMPT_FORMAT):
+    """
+    Returns the instructions and category list sent with every batch.
+    """
+    if prompt_format == "compact":
+        category_lines = "\n".join(f"{index} {category}" for index, category in enumerate(AVAILABLE_CATEGORIES))
+        return (
+            "You are an expert financial assistant. You will be given bank transactions, one per line, as <id><TAB><details>.\n"
+            "Categorize each transaction and return a valid JSON object with a single key \"categorized_transactions\", "
+            "an array of objects {\"id\": <id>, \"category\": <category number>}.\n"
+            f"Use only the category numbers below. When in doubt, use {AVAILABLE_CATEGORIES.index('Uncategorized')}. "
+            "Do not include any other text or explanations in your response.\n"
+            f"Categories:\n{category_lines}"
+        )
+    return f"""
     You are an expert financial assistant. You will be given a JSON array of bank transactions.
     Your task is to categorize each transaction and return a valid JSON object as a response.
     The JSON object MUST contain a single key, "categorized_transactions", which is an array of objects.
@@ -74,46 +978,1077 @@ def get_ai_categories_batch(client, provider, transactions_to_process):
     The category MUST be one of the following: {AVAILABLE_CATEGORIES}. When in doubt, categorize as "Uncategorized".
     Do not include any other text or explanations in your response.
     """
-    print(system_prompt)
-    print(f"Sending batch to {provider} for categorization...")
+
+def normalized_detail(trx):
+    """
+    Key under which transactions with identical details are coalesced into one prompt line.
+    """
+    return transaction_detail(trx).casefold()
+
+class JsonArrayScanner:
+    """
+    Incrementally extracts the complete objects inside JSON arrays from (possibly partial) JSON text.
+    Used to salvage truncated answers, where everything up to the last complete object is still usable.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.object_start = None
+
+    def feed(self, text):
+        """
+        Adds more text and returns the objects that became complete.
+        """
+        self.buffer += text
+        objects = []
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                if char == "{" and self.stack and self.stack[-1] == "[" and self.object_start is None:
+                    self.object_start = self.position
+                self.stack.append(char)
+            elif char in "}]" and self.stack:
+                self.stack.pop()
+                if char == "}" and self.object_start is not None and self.stack and self.stack[-1] == "[":
+                    try:
+                        objects.append(json.loads(self.buffer[self.object_start:self.position + 1]))
+                    except ValueError:
+                        pass
+                    self.object_start = None
+            self.position += 1
+
+        # Drop text that can no longer be part of an object to keep the buffer small.
+        keep_from = self.object_start if self.object_start is not None else self.position
+        self.buffer = self.buffer[keep_from:]
+        self.position -= keep_from
+        if self.object_start is not None:
+            self.object_start = 0
+        return objects
+
+def salvage_json_objects(text):
+    """
+    Returns every complete object from the arrays in a malformed or truncated JSON answer.
+    """
+    return JsonArrayScanner().feed(text)
+
+def response_schema(prompt_format=PROMPT_FORMAT):
+    """
+    JSON schema of the expected answer, with the allowed categories as an enum. It deliberately does not
+    depend on the batch, so it stays part of the cacheable prompt prefix.
+    """
+    if prompt_format == "compact":
+        category_schema = {"type": "integer", "enum": list(range(len(AVAILABLE_CATEGORIES)))}
+    else:
+        category_schema = {"type": "string", "enum": list(AVAILABLE_CATEGORIES)}
+    return {
+        "type": "object",
+        "properties": {
+            "categorized_transactions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"id": {"type": "integer"}, "category": category_schema},
+                    "required": ["id", "category"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["categorized_transactions"],
+        "additionalProperties": False,
+    }
+
+class EncodedBatch:
+    """
+    A batch of transactions serialized for the model. Transactions with identical normalized details are
+    sent once: `aliases` maps each id the model sees to the list of real transaction ids it stands for,
+    and `details` maps it to the transaction text.
+    """
+
+    def __init__(self, transactions, prompt_format=PROMPT_FORMAT):
+        self.prompt_format = prompt_format
+        self.system_prompt = build_system_prompt(prompt_format)
+        self.transaction_count = 0
+        self.aliases = {}
+        self.details = {}
+        alias_by_detail = {}
+        for trx in transactions:
+            self.transaction_count += 1
+            key = normalized_detail(trx)
+            if key in alias_by_detail:
+                self.aliases[alias_by_detail[key]].append(trx["id"])
+                continue
+            # Compact batches use short per-batch integer aliases instead of MoneyMoney's long ids.
+            alias = len(self.aliases) + 1 if prompt_format == "compact" else trx["id"]
+            alias_by_detail[key] = alias
+            self.aliases[alias] = [trx["id"]]
+            if prompt_format == "compact":
+                self.details[alias] = transaction_detail(trx)
+            else:
+                self.details[alias] = f"{trx.get('name', '')} - {trx.get('purpose', '')}"
+
+        if prompt_format == "compact":
+            self.user_content = "\n".join(f"{alias}\t{detail}" for alias, detail in self.details.items())
+        else:
+            input_json_list = [{"id": trx_id, "detail": detail} for trx_id, detail in self.details.items()]
+            self.user_content = json.dumps(input_json_list, indent=2)
+
+    def __len__(self):
+        return len(self.aliases)
+
+    def category_value(self, category):
+        """
+        Returns how `category` is written in this batch's wire format.
+        """
+        return AVAILABLE_CATEGORIES.index(category) if self.prompt_format == "compact" else category
+
+    def decode(self, response_content):
+        """
+        Turns the model's JSON answer (text, or an already parsed tool input) into a real-id -> category map,
+        fanning each answer out to all transactions coalesced under its id. Truncated or malformed JSON is
+        salvaged up to the last complete entry; unknown ids and invalid categories are dropped.
+        """
+        if isinstance(response_content, str):
+            try:
+                categorized_list = json.loads(response_content).get("categorized_transactions", [])
+            except (ValueError, AttributeError):
+                categorized_list = salvage_json_objects(response_content)
+                print(f"🩹 Malformed AI answer, salvaged {len(categorized_list)} complete entries.")
+        else:
+            categorized_list = response_content.get("categorized_transactions", [])
+
+        id_to_category_map = {}
+        for item in categorized_list:
+            id_to_category_map.update(self.decode_item(item))
+        return id_to_category_map
+
+    def decode_item(self, item):
+        """
+        Decodes one {"id": ..., "category": ...} entry of the answer into a real-id -> category map,
+        which is empty if the entry is invalid.
+        """
+        if not isinstance(item, dict):
+            return {}
+        category = item.get("category")
+        if self.prompt_format == "compact":
+            if not isinstance(category, int) or not 0 <= category < len(AVAILABLE_CATEGORIES):
+                return {}
+            category = AVAILABLE_CATEGORIES[category]
+        elif category not in AVAILABLE_CATEGORIES:
+            return {}
+        return {trx_id: category for trx_id in self.aliases.get(item.get("id"), ())}
+
+    def prompt_tokens(self):
+        return count_tokens(self.system_prompt) + count_tokens(self.user_content)
+
+# --- Rate Limiting and Retries ---
+
+class RateLimiter:
+    """
+    Token buckets for a provider's requests-per-minute and tokens-per-minute budgets, shared by all worker
+    threads. A rate-limit response can pause every worker via `pause`.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = {key: float(limit) for key, limit in self.limits.items() if limit}
+        self.paused_until = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        for key in self.available:
+            self.available[key] = min(self.limits[key], self.available[key] + elapsed * self.limits[key] / 60.0)
+
+    def acquire(self, tokens):
+        """
+        Blocks until one request using about `tokens` tokens fits into both budgets, then books it.
+        """
+        cost = {"requests": 1.0, "tokens": float(tokens)}
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                delay = max(0.0, self.paused_until - now)
+                for key, available in self.available.items():
+                    needed = min(cost[key], self.limits[key])
+                    if available < needed:
+                        delay = max(delay, (needed - available) * 60.0 / self.limits[key])
+                if delay <= 0:
+                    for key in self.available:
+                        self.available[key] -= min(cost[key], self.limits[key])
+                    return
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """
+        Stops all workers from sending requests for the next `seconds`.
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+def _parse_duration(value):
+    """
+    Parses rate-limit header values such as "2", "1.5s", "250ms" or "6m0s" into seconds.
+    """
+    value = str(value).strip()
     try:
-        response_content = ""
-        # OpenAI and DeepSeek use the same API structure
-        if provider == "openai" or provider == "deepseek":
-            model_name = "gpt-4o" if provider == "openai" else "deepseek-chat"
-            response = client.chat.completions.create(
-                model=model_name,
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": input_json_string}
-                ]
-            )
-            response_content = response.choices[0].message.content
-        
-        elif provider == "anthropic":
-            response = client.messages.create(
-                model="claude-3-sonnet-20240229",
-                max_tokens=4096,
-                system=system_prompt,
-                messages=[
-                    {"role": "user", "content": input_json_string}
-                ]
-            )
-            response_content = response.content[0].text
-        
-        print("✅ AI call successful. Parsing response...")
-        categorized_list = json.loads(response_content).get("categorized_transactions", [])
-        id_to_category_map = {item['id']: item['category'] for item in categorized_list}
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def retry_after_seconds(error):
+    """
+    Returns how long the provider asked us to wait, based on the error response's headers, or None.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        milliseconds = _parse_duration(headers["retry-after-ms"])
+        if milliseconds is not None:
+            return milliseconds / 1000.0
+    if headers.get("retry-after"):
+        seconds = _parse_duration(headers["retry-after"])
+        if seconds is None:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(headers["retry-after"])
+                seconds = (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        return max(0.0, seconds)
+    resets = [_parse_duration(headers[name]) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens") if headers.get(name)]
+    resets = [seconds for seconds in resets if seconds is not None]
+    return max(resets) if resets else None
+
+def is_retryable_error(error):
+    """
+    Rate limits, timeouts, conflicts, server errors and connection problems are worth retrying.
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in (408, 409, 429) or status_code >= 500
+    return isinstance(error, (OpenAIConnectionError, anthropic.APIConnectionError))
+
+def backoff_delay(attempt):
+    """
+    Exponential backoff with full jitter for the given (zero-based) retry attempt.
+    """
+    return random.uniform(0, min(AI_RETRY_MAX_DELAY, AI_RETRY_BASE_DELAY * 2 ** attempt))
+
+# --- Adaptive Batch Sizing ---
+
+class BatchSizeController:
+    """
+    Chooses the number of transactions per AI request for one provider. The size is capped so that the
+    expected answer fits into the provider's output limit and the prompt into its context window (using
+    running averages of the observed tokens per transaction). Within those caps it grows step by step
+    while requests are fast and complete, and halves after a truncated answer, an error or a slow request.
+    """
+
+    def __init__(self, provider, initial_size=AI_BATCH_SIZE):
+        self.provider = provider
+        self.size = initial_size
+        self.output_tokens_per_transaction = float(provider.output_tokens_per_transaction)
+        self.input_tokens_per_transaction = None
+        self._lock = threading.Lock()
+
+    def _limit(self):
+        # Leave 20% headroom, since single answers vary around the average.
+        limit = int(self.provider.max_output_tokens * 0.8 / max(self.output_tokens_per_transaction, 1.0))
+        if self.input_tokens_per_transaction:
+            limit = min(limit, int(self.provider.context_window * 0.8 / self.input_tokens_per_transaction))
+        return max(AI_MIN_BATCH_SIZE, min(AI_MAX_BATCH_SIZE, limit))
+
+    def next_size(self):
+        with self._lock:
+            return min(self.size, self._limit())
+
+    def _resize(self, new_size, reason):
+        new_size = max(AI_MIN_BATCH_SIZE, min(new_size, self._limit()))
+        if new_size != self.size:
+            print(f"🎚️ Batch size for {self.provider.name}: {self.size} -> {new_size} ({reason}, "
+                  f"~{self.output_tokens_per_transaction:.1f} output tokens per transaction).")
+            self.size = new_size
+
+    def record_success(self, transaction_count, latency, call):
+        """
+        Feeds back a completed request: its latency and the token counts and truncation flag from `call`.
+        """
+        with self._lock:
+            if call.get("output_tokens") and not call.get("truncated"):
+                observed = call["output_tokens"] / transaction_count
+                self.output_tokens_per_transaction += 0.3 * (observed - self.output_tokens_per_transaction)
+            if call.get("input_tokens"):
+                observed = call["input_tokens"] / transaction_count
+                previous = self.input_tokens_per_transaction or observed
+                self.input_tokens_per_transaction = previous + 0.3 * (observed - previous)
+
+            if call.get("truncated"):
+                self._resize(transaction_count // 2, "answer was truncated")
+            elif latency > AI_TARGET_LATENCY:
+                self._resize(self.size // 2, f"request took {latency:.1f}s")
+            elif transaction_count >= self.size:
+                self._resize(self.size + AI_BATCH_SIZE_STEP, f"request took {latency:.1f}s")
+
+    def record_failure(self, error):
+        with self._lock:
+            self._resize(self.size // 2, f"request failed: {error}")
+
+# --- AI Providers ---
+
+class ProviderConfigurationError(Exception):
+    """
+    Raised when an AI provider cannot be set up, e.g. because its API key is missing.
+    """
+
+PROVIDERS = {}
+
+def register_provider(name):
+    """
+    Class decorator that makes a provider available under `name` for AI_PROVIDER.
+    """
+    def decorator(cls):
+        cls.name = name
+        PROVIDERS[name] = cls
+        return cls
+    return decorator
+
+def create_provider(name, **options):
+    """
+    Instantiates the registered provider called `name`.
+    """
+    if name not in PROVIDERS:
+        choices = ", ".join(f"'{provider_name}'" for provider_name in PROVIDERS)
+        raise ProviderConfigurationError(f"Unknown AI_PROVIDER '{name}'. Please choose one of {choices}.")
+    return PROVIDERS[name](**options)
+
+def _require_api_key(provider_name, env_var):
+    api_key = os.getenv(env_var)
+    if not api_key:
+        raise ProviderConfigurationError(f"AI_PROVIDER is '{provider_name}' but {env_var} environment variable is not set.")
+    return api_key
+
+class CategorizationProvider:
+    """
+    Base class for AI backends. Subclasses own their client, model name, JSON mode and token limits,
+    and implement `_complete` (and optionally `_acomplete`) to turn an EncodedBatch into the raw response
+    (JSON text or an already parsed object). Providers that can stream also implement `_stream`, which
+    yields the answer's JSON text in pieces as it is generated.
+    """
+    name = None
+    model = None
+    max_output_tokens = 4096
+    context_window = 128000
+    # Rate-limit budgets; None means unlimited.
+    requests_per_minute = None
+    tokens_per_minute = None
+    # Rough completion size, used to book output tokens against the tokens-per-minute budget.
+    output_tokens_per_transaction = 12
+
+    def __init__(self, model=None):
+        self.model = model or self.model
+        self.rate_limiter = RateLimiter(self.requests_per_minute, self.tokens_per_minute)
+        self.usage = {"requests": 0, "input_tokens": 0, "cached_input_tokens": 0, "output_tokens": 0}
+        self._usage_lock = threading.Lock()
+        self._last_call = threading.local()
+
+    def record_usage(self, input_tokens, cached_input_tokens, output_tokens, truncated=False):
+        """
+        Adds one response's token counts to the running totals. `input_tokens` includes the cached ones.
+        The counts are also kept per thread for `last_call`.
+        """
+        self._last_call.stats = {"input_tokens": input_tokens, "output_tokens": output_tokens, "truncated": truncated}
+        METRICS.observe("batch_input_tokens", input_tokens or 0, provider=self.name)
+        METRICS.observe("batch_output_tokens", output_tokens or 0, provider=self.name)
+        if truncated:
+            METRICS.increment("truncated_answers", provider=self.name)
+        with self._usage_lock:
+            self.usage["requests"] += 1
+            self.usage["input_tokens"] += input_tokens or 0
+            self.usage["cached_input_tokens"] += cached_input_tokens or 0
+            self.usage["output_tokens"] += output_tokens or 0
+
+    def last_call(self):
+        """
+        Token counts and truncation flag of the last response received on the current thread.
+        """
+        return getattr(self._last_call, "stats", {})
+
+    def usage_summary(self):
+        usage = self.usage
+        cached_share = usage["cached_input_tokens"] / usage["input_tokens"] if usage["input_tokens"] else 0.0
+        uncached = usage["input_tokens"] - usage["cached_input_tokens"]
+        return (f"{usage['input_tokens']} input ({usage['cached_input_tokens']} cached, {uncached} uncached, "
+                f"{cached_share:.0%} cache hits), {usage['output_tokens']} output in {usage['requests']} requests")
+
+    def categorize(self, transactions, on_result=None):
+        """
+        Categorizes a batch of transactions and returns an id -> category map. With `on_result` and
+        AI_STREAMING, the answer is streamed and `on_result(transaction_id, category)` is called for each
+        transaction as soon as its entry is complete, while the model is still generating the rest.
+        """
+        with METRICS.timer("prompt_build_seconds", provider=self.name):
+            batch = EncodedBatch(transactions)
+        self.rate_limiter.acquire(self._estimated_tokens(batch))
+        if on_result is not None and AI_STREAMING:
+            return self._categorize_streaming(batch, on_result)
+        id_to_category_map = batch.decode(self._complete(batch))
+        if on_result is not None:
+            for trx_id, category in id_to_category_map.items():
+                on_result(trx_id, category)
         return id_to_category_map
-        
+
+    def _categorize_streaming(self, batch, on_result):
+        id_to_category_map = {}
+        scanner = JsonArrayScanner()
+        for text in self._stream(batch):
+            for item in scanner.feed(text):
+                decoded = batch.decode_item(item)
+                id_to_category_map.update(decoded)
+                for trx_id, category in decoded.items():
+                    on_result(trx_id, category)
+        return id_to_category_map
+
+    async def acategorize(self, transactions):
+        """
+        Async variant of `categorize`.
+        """
+        batch = EncodedBatch(transactions)
+        await asyncio.to_thread(self.rate_limiter.acquire, self._estimated_tokens(batch))
+        return batch.decode(await self._acomplete(batch))
+
+    def _estimated_tokens(self, batch):
+        if not self.tokens_per_minute:
+            return 0
+        return batch.prompt_tokens() + self.output_tokens_per_transaction * len(batch)
+
+    def _complete(self, batch):
+        raise NotImplementedError
+
+    def _stream(self, batch):
+        response_content = self._complete(batch)
+        yield response_content if isinstance(response_content, str) else json.dumps(response_content)
+
+    async def _acomplete(self, batch):
+        return await asyncio.to_thread(self._complete, batch)
+
+    def __str__(self):
+        return f"{self.name} ({self.model})"
+
+@register_provider("openai")
+class OpenAIProvider(CategorizationProvider):
+    model = "gpt-4o"
+    max_output_tokens = 16384
+    requests_per_minute = 500
+    tokens_per_minute = 30000
+    api_key_env = "OPENAI_API_KEY"
+    base_url = None
+    supports_json_schema = True
+
+    def __init__(self, model=None):
+        super().__init__(model)
+        self.api_key = _require_api_key(self.name, self.api_key_env)
+        self.client = OpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+        self._async_client = None
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+        return self._async_client
+
+    def _request(self, batch):
+        # The system prompt is identical for every batch and sent first, so OpenAI and DeepSeek can serve it
+        # from their automatic prefix cache (OpenAI caches prefixes of 1024 tokens and more).
+        if AI_OUTPUT_MODE == "structured" and self.supports_json_schema:
+            response_format = {
+                "type": "json_schema",
+                "json_schema": {"name": "categorized_transactions", "strict": True, "schema": response_schema(batch.prompt_format)},
+            }
+        else:
+            response_format = {"type": "json_object"}
+        return dict(
+            model=self.model,
+            max_tokens=self.max_output_tokens,
+            response_format=response_format,
+            messages=[
+                {"role": "system", "content": batch.system_prompt},
+                {"role": "user", "content": batch.user_content}
+            ]
+        )
+
+    def _record_response_usage(self, response):
+        usage = response.usage
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        truncated = response.choices[0].finish_reason == "length"
+        self.record_usage(usage.prompt_tokens, cached_tokens, usage.completion_tokens, truncated)
+
+    def _complete(self, batch):
+        response = self.client.chat.completions.create(**self._request(batch))
+        self._record_response_usage(response)
+        return response.choices[0].message.content
+
+    async def _acomplete(self, batch):
+        response = await self.async_client.chat.completions.create(**self._request(batch))
+        self._record_response_usage(response)
+        return response.choices[0].message.content
+
+    def _stream(self, batch):
+        stream = self.client.chat.completions.create(**self._request(batch), stream=True, stream_options={"include_usage": True})
+        finish_reason = None
+        for chunk in stream:
+            if chunk.choices:
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                if chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+            if chunk.usage is not None:
+                self._record_stream_usage(chunk.usage, finish_reason)
+
+    def _record_stream_usage(self, usage, finish_reason):
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or getattr(usage, "prompt_cache_hit_tokens", None) or 0
+        self.record_usage(usage.prompt_tokens, cached_tokens, usage.completion_tokens, finish_reason == "length")
+
+@register_provider("deepseek")
+class DeepSeekProvider(OpenAIProvider):
+    # DeepSeek speaks the OpenAI API, so the OpenAI client is reused with a different endpoint.
+    model = "deepseek-chat"
+    max_output_tokens = 8192
+    context_window = 64000
+    # DeepSeek does not publish fixed rate limits, it slows responses down under load instead.
+    requests_per_minute = None
+    tokens_per_minute = None
+    api_key_env = "DEEPSEEK_API_KEY"
+    base_url = "https://api.deepseek.com/v1"
+    supports_json_schema = False
+
+    def _record_response_usage(self, response):
+        # DeepSeek reports its context cache hits in its own usage field.
+        usage = response.usage
+        if usage is None:
+            return
+        truncated = response.choices[0].finish_reason == "length"
+        self.record_usage(usage.prompt_tokens, getattr(usage, "prompt_cache_hit_tokens", 0), usage.completion_tokens, truncated)
+
+@register_provider("anthropic")
+class AnthropicProvider(CategorizationProvider):
+    model = "claude-3-sonnet-20240229"
+    max_output_tokens = 4096
+    context_window = 200000
+    requests_per_minute = 50
+    tokens_per_minute = 40000
+    api_key_env = "ANTHROPIC_API_KEY"
+
+    def __init__(self, model=None):
+        super().__init__(model)
+        self.api_key = _require_api_key(self.name, self.api_key_env)
+        self.client = anthropic.Anthropic(api_key=self.api_key, max_retries=0)
+        self._async_client = None
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = anthropic.AsyncAnthropic(api_key=self.api_key, max_retries=0)
+        return self._async_client
+
+    tool_name = "record_categories"
+
+    def _request(self, batch):
+        request = dict(
+            model=self.model,
+            max_tokens=self.max_output_tokens,
+            # Marking the static system prompt as cacheable lets Anthropic reuse it across batches
+            # (the prefix must be at least 1024 tokens, e.g. with a long category list).
+            system=[{"type": "text", "text": batch.system_prompt, "cache_control": {"type": "ephemeral"}}],
+            messages=[
+                {"role": "user", "content": batch.user_content}
+            ]
+        )
+        if AI_OUTPUT_MODE == "structured":
+            # Forcing a tool call makes the answer a schema-validated object instead of free-form text.
+            request["tools"] = [{
+                "name": self.tool_name,
+                "description": "Record the category of every transaction.",
+                "input_schema": response_schema(batch.prompt_format),
+            }]
+            request["tool_choice"] = {"type": "tool", "name": self.tool_name}
+        return request
+
+    def _response_content(self, response):
+        for block in response.content:
+            if block.type == "tool_use":
+                return block.input
+        return response.content[0].text
+
+    def _record_response_usage(self, response):
+        usage = response.usage
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+        truncated = response.stop_reason == "max_tokens"
+        self.record_usage(usage.input_tokens + cache_read + cache_write, cache_read, usage.output_tokens, truncated)
+
+    def _complete(self, batch):
+        response = self.client.messages.create(**self._request(batch))
+        self._record_response_usage(response)
+        return self._response_content(response)
+
+    async def _acomplete(self, batch):
+        response = await self.async_client.messages.create(**self._request(batch))
+        self._record_response_usage(response)
+        return self._response_content(response)
+
+    def _stream(self, batch):
+        with self.client.messages.stream(**self._request(batch)) as stream:
+            for event in stream:
+                if event.type != "content_block_delta":
+                    continue
+                # Tool use streams its input as partial JSON, plain answers as text.
+                if event.delta.type == "input_json_delta":
+                    yield event.delta.partial_json
+                elif event.delta.type == "text_delta":
+                    yield event.delta.text
+            self._record_response_usage(stream.get_final_message())
+
+@register_provider("fake")
+class FakeProvider(CategorizationProvider):
+    """
+    Offline provider for testing and benchmarking. Assigns each transaction a category derived from a hash
+    of its details, so results are deterministic, and optionally sleeps `latency` seconds per request.
+    """
+    model = "deterministic"
+
+    def __init__(self, model=None, latency=0.0):
+        super().__init__(model)
+        self.latency = latency
+
+    def _answer(self, batch):
+        self.record_usage(len(batch.system_prompt + batch.user_content) // 4, 0, 10 * len(batch))
+        categorized = []
+        for alias, detail in batch.details.items():
+            category = AVAILABLE_CATEGORIES[zlib.crc32(detail.encode("utf-8")) % len(AVAILABLE_CATEGORIES)]
+            categorized.append({"id": alias, "category": batch.category_value(category)})
+        return json.dumps({"categorized_transactions": categorized})
+
+    def _complete(self, batch):
+        time.sleep(self.latency)
+        return self._answer(batch)
+
+    async def _acomplete(self, batch):
+        await asyncio.sleep(self.latency)
+        return self._answer(batch)
+
+    def _stream(self, batch):
+        # Spread the latency over the answer, like a model generating it token by token.
+        answer = self._answer(batch)
+        pieces = [answer[start:start + 64] for start in range(0, len(answer), 64)]
+        for piece in pieces:
+            time.sleep(self.latency / len(pieces))
+            yield piece
+
+# --- Pipeline ---
+
+class PipelineStats:
+    """
+    Busy and blocked time per pipeline stage, used to report which stage is the bottleneck.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.busy_seconds = collections.defaultdict(float)
+        self.blocked_seconds = collections.defaultdict(float)
+        self.workers = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def busy(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.busy_seconds[stage] += time.monotonic() - start
+
+    def add_blocked(self, stage, seconds):
+        with self._lock:
+            self.blocked_seconds[stage] += seconds
+
+    def report(self):
+        """
+        Prints each stage's utilization: busy time over wall time times the number of workers.
+        """
+        wall = max(time.monotonic() - self.started, 1e-9)
+        print("--- ⏱️ Stage Utilization ---")
+        for stage, busy_seconds in self.busy_seconds.items():
+            workers = self.workers.get(stage, 1)
+            line = f"{stage}: {busy_seconds / (wall * workers):.0%} busy ({busy_seconds:.1f}s over {workers} worker{'s' if workers > 1 else ''})"
+            if self.blocked_seconds.get(stage):
+                line += f", {self.blocked_seconds[stage]:.1f}s blocked by the next stage"
+            print(line)
+
+def prefetch(iterable, stage, stats, maxsize=PIPELINE_QUEUE_SIZE):
+    """
+    Runs `iterable` on a background thread and yields its items through a bounded queue, so the producer
+    works ahead of the consumer by at most `maxsize` items. Exceptions are re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+    stopped = threading.Event()
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            while not stopped.is_set():
+                with stats.busy(stage):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                start = time.monotonic()
+                while not stopped.is_set():
+                    try:
+                        items.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                stats.add_blocked(stage, time.monotonic() - start)
+        except Exception as e:
+            items.put(e)
+            return
+        items.put(done)
+
+    threading.Thread(target=produce, name=f"{stage}-producer", daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+
+# --- Main Functions ---
+
+def _run_export_script(applescript_code, retries=EXPORT_MAX_RETRIES):
+    """
+    Runs a MoneyMoney export AppleScript, spooling its plist output to a temporary file. A failing script is
+    retried up to `retries` times with exponential backoff. Returns an iterator that parses the transactions
+    lazily, or None if the export failed.
+    """
+    command = ['osascript', '-e', applescript_code]
+    
+    export_file = tempfile.TemporaryFile()
+    try:
+        for attempt in range(retries + 1):
+            export_file.seek(0)
+            export_file.truncate()
+            with METRICS.timer("export_seconds"):
+                completed = subprocess.run(command, stdout=export_file, stderr=subprocess.PIPE)
+            if completed.returncode == 0:
+                break
+            METRICS.increment("export_failures")
+            error = completed.stderr.decode().strip()
+            if attempt < retries:
+                delay = EXPORT_RETRY_DELAY * 2 ** attempt
+                print(f"⏳ Export failed ({error}), retrying in {delay:.0f}s (attempt {attempt + 1} of {retries})...")
+                time.sleep(delay)
+        else:
+            print(f"❌ ERROR: Failed to export transactions. Error: {error}")
+            export_file.close()
+            return None
+        if not export_file.tell():
+            print("❌ ERROR: Export returned no data. Check if there are transactions in this category within the date range.")
+            export_file.close()
+            return None
+        METRICS.increment("export_bytes", export_file.tell())
+        print(f"✅ Transactions successfully exported ({export_file.tell()} bytes), parsing as a stream.")
+        export_file.seek(0)
     except Exception as e:
-        print(f"❌ ERROR: Could not get AI categories for batch. Error: {e}")
+        print(f"❌ ERROR: An unexpected error occurred during export. Error: {e}")
+        export_file.close()
+        return None
+
+    def transactions():
+        parse_seconds = 0.0
+        with export_file:
+            iterator = iter_plist_transactions(export_file)
+            while True:
+                start = time.perf_counter()
+                trx = next(iterator, None)
+                parse_seconds += time.perf_counter() - start
+                if trx is None:
+                    break
+                yield trx
+        METRICS.observe("parse_seconds", parse_seconds)
+    return transactions()
+
+def _export_transactions_script(category_uuid=None, account=None, from_date=None, to_date=None):
+    """
+    Builds the AppleScript that exports transactions as a plist, optionally restricted to one account,
+    one category and a date range.
+    """
+    command = 'tell application "MoneyMoney" to export transactions'
+    if account:
+        command += f' from account {_applescript_string(account)}'
+    if category_uuid:
+        command += f' from category {_applescript_string(category_uuid)}'
+    if from_date:
+        command += f' from date "{from_date.isoformat()}"'
+    if to_date:
+        command += f' to date "{to_date.isoformat()}"'
+    return command + ' as "plist"'
+
+def export_transactions_from_moneymoney(category_uuid, from_date=None, accounts=None, extra_categories=None):
+    """
+    Executes an AppleScript to export all transactions from a specific category UUID AND a date range.
+    Without `from_date`, the last DAYS_TO_EXPORT days are exported. The export is spooled to a temporary
+    file and returned as an iterator that parses transactions lazily, or None if the export failed.
+    With several `accounts` (default EXPORT_ACCOUNTS), `extra_categories` (default EXPORT_CATEGORIES) or
+    date slices (EXPORT_SLICE_DAYS), the exports are fanned out and merged by a ParallelExport.
+    """
+    if from_date is None:
+        from_date = datetime.date.today() - datetime.timedelta(days=DAYS_TO_EXPORT)
+    accounts = EXPORT_ACCOUNTS if accounts is None else accounts
+    extra_categories = EXPORT_CATEGORIES if extra_categories is None else extra_categories
+    categories = [category_uuid] + [uuid for uuid in extra_categories if uuid != category_uuid]
+    today = datetime.date.today()
+    # A high-water mark from a future-dated booking must not produce an empty range.
+    from_date = min(from_date, today)
+    slices = date_slices(from_date, today, EXPORT_SLICE_DAYS) if EXPORT_SLICE_DAYS else [(from_date, None)]
+    # Listed oldest slice first, which is also the order in which the exports start.
+    jobs = [
+        {"category_uuid": uuid, "account": account, "from_date": slice_start, "to_date": slice_end if slice_end != today else None}
+        for slice_start, slice_end in slices for account in (accounts or [None]) for uuid in categories
+    ]
+    if len(jobs) > 1:
+        print(f"👉 Step 1: Exporting transactions since {from_date.isoformat()} in {len(jobs)} exports "
+              f"({len(slices)} date slices x {len(accounts or [None])} accounts x {len(categories)} categories), {EXPORT_CONCURRENCY} at a time...")
+        return ParallelExport(jobs)
+
+    print(f"👉 Step 1: Exporting transactions from category '{category_uuid}' since {from_date.isoformat()}...")
+    return _run_export_script(_export_transactions_script(**jobs[0]))
+
+class ParallelExport:
+    """
+    Runs one export per job (keyword arguments for _export_transactions_script), at most `max_concurrency`
+    at a time. Iterating yields the transactions of each export as soon as it has finished, skipping ids that
+    were already yielded. Exports that still fail after their retries are left out and kept in `failed_jobs`.
+    """
+
+    def __init__(self, jobs, max_concurrency=EXPORT_CONCURRENCY):
+        self.jobs = jobs
+        self.max_concurrency = max_concurrency
+        self.failed_jobs = []
+
+    def __iter__(self):
+        seen_ids = set()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="moneymoney-export") as executor:
+            futures = {executor.submit(_run_export_script, _export_transactions_script(**job)): job for job in self.jobs}
+            for future in as_completed(futures):
+                transactions = future.result()
+                if transactions is None:
+                    job = futures[future]
+                    self.failed_jobs.append(job)
+                    print(f"⚠️ WARNING: Export of account '{job.get('account') or 'all'}', category '{job.get('category_uuid') or 'all'}' "
+                          f"since {job['from_date'].isoformat()} failed, continuing with the other exports.")
+                    continue
+                for trx in transactions:
+                    if trx["id"] in seen_ids:
+                        continue
+                    seen_ids.add(trx["id"])
+                    yield trx
+        if self.failed_jobs:
+            print(f"⚠️ {len(self.failed_jobs)} of {len(self.jobs)} exports failed.")
+
+def date_slices(from_date, to_date, slice_days):
+    """
+    Splits the inclusive range from_date..to_date into consecutive (start, end) ranges of at most `slice_days` days.
+    """
+    slices = []
+    start = from_date
+    while start <= to_date:
+        end = min(to_date, start + datetime.timedelta(days=slice_days - 1))
+        slices.append((start, end))
+        start = end + datetime.timedelta(days=1)
+    return slices
+
+def export_history_from_moneymoney(days=HISTORY_DAYS, slice_days=HISTORY_SLICE_DAYS):
+    """
+    Exports all categorized transactions of the last `days` days, one AppleScript call per date slice so that
+    each export stays small. Yields (transaction_id, booking_date, fingerprint, category) tuples.
+    """
+    to_date = datetime.date.today()
+    for slice_start, slice_end in date_slices(to_date - datetime.timedelta(days=days), to_date, slice_days):
+        print(f"👉 Exporting categorized history from {slice_start.isoformat()} to {slice_end.isoformat()}...")
+        transactions = _run_export_script(_export_transactions_script(from_date=slice_start, to_date=slice_end))
+        if transactions is None:
+            continue
+        for trx in transactions:
+            category = trx.get("category")
+            if not category or category == "Uncategorized" or trx.get("categoryUuid") == UNCATGEGORIZED_CATEGORY_UUID:
+                continue
+            yield trx["id"], _booking_date(trx), transaction_fingerprint(trx), category
+
+def _categorize_with_retries(provider, transactions_to_process, controller=None, on_result=None):
+    """
+    Calls the provider, retrying rate limits and transient errors for this batch only. It waits as long as
+    the provider's Retry-After asks (pausing all workers) or uses jittered exponential backoff.
+    Results already passed to `on_result` by a stream that failed partway are kept, and only the remaining
+    transactions are sent again. Latency, token counts and errors are reported to the batch size
+    `controller`, if any. Returns None if the batch still fails without any streamed results.
+    """
+    emitted = {}
+
+    def collect(trx_id, category):
+        emitted[trx_id] = category
+        on_result(trx_id, category)
+
+    remaining = transactions_to_process
+    for attempt in range(AI_MAX_RETRIES + 1):
+        if attempt:
+            remaining = [trx for trx in transactions_to_process if trx["id"] not in emitted]
+            if not remaining:
+                return dict(emitted)
+        start = time.monotonic()
+        try:
+            id_to_category_map = provider.categorize(remaining, collect if on_result else None)
+            METRICS.observe("api_latency_seconds", time.monotonic() - start, provider=provider.name)
+            if controller:
+                controller.record_success(len(remaining), time.monotonic() - start, provider.last_call())
+            # What was handed out first stands, so the returned map agrees with what was written.
+            id_to_category_map.update(emitted)
+            return id_to_category_map
+
+        except Exception as e:
+            METRICS.increment("api_errors", provider=provider.name, status=getattr(e, "status_code", None) or type(e).__name__)
+            # Rate limits say nothing about the batch size, everything else suggests a smaller batch.
+            if controller and getattr(e, "status_code", None) != 429:
+                controller.record_failure(e)
+            if attempt == AI_MAX_RETRIES or not is_retryable_error(e):
+                print(f"❌ ERROR: Could not get AI categories for batch. Error: {e}")
+                # Results streamed before the failure were already handed out, and the rest can be re-queried.
+                return dict(emitted) if emitted else None
+            delay = retry_after_seconds(e)
+            if delay is not None and getattr(e, "status_code", None) == 429:
+                provider.rate_limiter.pause(delay)
+            delay = delay if delay is not None else backoff_delay(attempt)
+            print(f"⏳ AI request failed ({e}), retrying batch in {delay:.1f}s (attempt {attempt + 1} of {AI_MAX_RETRIES})...")
+            time.sleep(delay)
+
+def get_ai_categories_batch(provider, transactions_to_process, requery_rounds=AI_REQUERY_ROUNDS, controller=None, on_result=None):
+    """
+    Sends a batch of transactions to the selected AI provider. Transactions missing from the answer (or
+    answered with an invalid category) are re-queried on their own in a smaller follow-up batch, up to
+    `requery_rounds` times. `on_result(transaction_id, category)` is called for every result as it arrives.
+    Returns {} if the batch fails.
+    """
+    print(f"Sending batch of {len(transactions_to_process)} transactions to {provider} for categorization...")
+    id_to_category_map = _categorize_with_retries(provider, transactions_to_process, controller, on_result)
+    if id_to_category_map is None:
         return {}
+    print("✅ AI call successful.")
+
+    missing = [trx for trx in transactions_to_process if trx["id"] not in id_to_category_map]
+    if missing and requery_rounds > 0:
+        print(f"🩹 {len(missing)} of {len(transactions_to_process)} transactions missing or invalid in the answer, re-querying only those...")
+        # If nothing usable came back, halve the batch so the follow-up is smaller than what just failed.
+        if len(missing) == len(transactions_to_process) and len(missing) > 1:
+            follow_ups = [missing[:len(missing) // 2], missing[len(missing) // 2:]]
+        else:
+            follow_ups = [missing]
+        for follow_up in follow_ups:
+            id_to_category_map.update(get_ai_categories_batch(provider, follow_up, requery_rounds - 1, controller, on_result))
+    return id_to_category_map
+
+def _chunked(iterable, size):
+    """
+    Yields lists of at most `size` items from `iterable` without materializing it.
+    `size` may also be a function, which is asked again for every chunk.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size() if callable(size) else size))
+        if not chunk:
+            return
+        yield chunk
+
+def get_ai_categories_chunked(provider, transactions_to_process, batch_size=AI_BATCH_SIZE, max_concurrency=AI_MAX_CONCURRENCY, on_result=None, stats=None, on_batch=None):
+    """
+    Splits the transactions into batches of `batch_size` and categorizes them concurrently,
+    keeping at most `max_concurrency` requests in flight. With AI_ADAPTIVE_BATCH_SIZE, `batch_size` is only
+    the starting point for a BatchSizeController. `on_result` is passed on to get_ai_categories_batch,
+    and the workers' busy time is recorded in `stats`. `on_batch(id_to_category_map)` is called with each
+    batch's answers as soon as the batch is done. Returns the merged id -> category map.
+    """
+    stats = stats or PipelineStats()
+    stats.workers["categorize"] = max_concurrency
+
+    def categorize_batch(batch):
+        with stats.busy("categorize"):
+            id_to_category_map = get_ai_categories_batch(provider, batch, AI_REQUERY_ROUNDS, controller, on_result)
+        if on_batch:
+            on_batch(id_to_category_map)
+        return id_to_category_map
+
+    id_to_category_map = {}
+    prompt_tokens = {"transactions": 0, "json": 0, "compact": 0}
+    coalesced = 0
+    controller = BatchSizeController(provider, batch_size) if AI_ADAPTIVE_BATCH_SIZE else None
+    batches = _chunked(transactions_to_process, controller.next_size if controller else batch_size)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        in_flight = set()
+        for batch_number, batch in enumerate(batches, start=1):
+            if len(in_flight) >= max_concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    id_to_category_map.update(future.result())
+            print(f"📦 Dispatching batch {batch_number} ({len(batch)} transactions)...")
+            in_flight.add(executor.submit(categorize_batch, batch))
+            coalesced += len(batch) - len({normalized_detail(trx) for trx in batch})
+            if REPORT_PROMPT_TOKENS:
+                prompt_tokens["transactions"] += len(batch)
+                for prompt_format in ("json", "compact"):
+                    prompt_tokens[prompt_format] += EncodedBatch(batch, prompt_format).prompt_tokens()
+        for future in in_flight:
+            id_to_category_map.update(future.result())
+
+    if controller:
+        print(f"🎚️ Final batch size for {provider.name}: {controller.size}.")
+    if coalesced:
+        print(f"🧬 Coalesced {coalesced} transactions with duplicate details into shared prompt lines.")
+    if prompt_tokens["transactions"]:
+        per_transaction = {key: prompt_tokens[key] / prompt_tokens["transactions"] for key in ("json", "compact")}
+        print(f"🔢 Prompt tokens per transaction: {per_transaction['json']:.1f} (json) -> {per_transaction['compact']:.1f} (compact), sent as '{PROMPT_FORMAT}'.")
+    return id_to_category_map
 
 def update_transaction_in_moneymoney(transaction_id, new_category):
     """
-    Executes an AppleScript to update a single transaction's category.
+    Executes an AppleScript to update a single transaction's category. `new_category` is a category name or UUID.
     """
     # ✨ DEFINITIVE FIX ✨
     # Based on the correct documentation, this is the required command structure.
@@ -121,70 +2056,442 @@ def update_transaction_in_moneymoney(transaction_id, new_category):
     applescript_code = f'tell application "MoneyMoney" to set transaction id {transaction_id} category to "{new_category}"'
     
     try:
-        subprocess.run(['osascript', '-e', applescript_code], check=True, capture_output=True, text=True)
+        with METRICS.timer("update_seconds_per_transaction", mode="single"):
+            subprocess.run(['osascript', '-e', applescript_code], check=True, capture_output=True, text=True)
+        return True
     except subprocess.CalledProcessError as e:
+        METRICS.increment("update_failures")
         print(f"❌ ERROR: Failed to update transaction ID {transaction_id}. AppleScript error: {e.stderr.strip()}")
+        return False
+
+def _applescript_string(value):
+    """
+    Quotes a Python string as an AppleScript string literal.
+    """
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _build_bulk_update_script(updates, category_uuids=None):
+    """
+    Builds one AppleScript that applies every (transaction_id, category) pair in `updates`, setting categories
+    by UUID where `category_uuids` knows one and by name otherwise.
+    Each update runs in its own try block, and the IDs of failed updates are returned as a comma-separated string.
+    """
+    category_uuids = category_uuids or {}
+    lines = ['set failedIds to {}', 'tell application "MoneyMoney"']
+    for transaction_id, new_category in updates:
+        lines += [
+            '    try',
+            f'        set transaction id {int(transaction_id)} category to {_applescript_string(category_uuids.get(new_category, new_category))}',
+            '    on error',
+            f'        set end of failedIds to "{int(transaction_id)}"',
+            '    end try',
+        ]
+    lines += [
+        'end tell',
+        "set AppleScript's text item delimiters to \",\"",
+        'return failedIds as text',
+    ]
+    return "\n".join(lines)
+
+def update_transactions_in_moneymoney_bulk(updates, chunk_size=UPDATE_CHUNK_SIZE, category_uuids=None):
+    """
+    Updates many transactions with one osascript process per chunk instead of one per transaction.
+    `updates` maps transaction IDs to category names, which are written as UUIDs if `category_uuids` has them. Returns a dict mapping each transaction ID to
+    True (updated) or False (failed). Chunks whose script fails as a whole are retried per transaction.
+    """
+    results = {}
+    items = list(updates.items())
+    for start in range(0, len(items), chunk_size):
+        chunk = items[start:start + chunk_size]
+        applescript_code = _build_bulk_update_script(chunk, category_uuids)
+        started = time.perf_counter()
+        try:
+            completed = subprocess.run(['osascript', '-'], input=applescript_code, check=True, capture_output=True, text=True)
+            METRICS.observe("update_seconds_per_transaction", (time.perf_counter() - started) / len(chunk), mode="bulk")
+        except subprocess.CalledProcessError as e:
+            print(f"⚠️ WARNING: Bulk update of {len(chunk)} transactions failed, falling back to single updates. AppleScript error: {e.stderr.strip()}")
+            for transaction_id, new_category in chunk:
+                results[transaction_id] = update_transaction_in_moneymoney(transaction_id, (category_uuids or {}).get(new_category, new_category))
+            continue
+
+        failed_ids = {item.strip() for item in completed.stdout.strip().split(",") if item.strip()}
+        for transaction_id, new_category in chunk:
+            succeeded = str(int(transaction_id)) not in failed_ids
+            if not succeeded:
+                METRICS.increment("update_failures")
+                print(f"❌ ERROR: Failed to update transaction ID {transaction_id} to '{new_category}'.")
+            results[transaction_id] = succeeded
+    return results
+
+class UpdateWorker:
+    """
+    Background thread that writes categories to MoneyMoney while categorization is still running.
+    Submitted updates are collected and written with update_transactions_in_moneymoney_bulk once
+    `chunk_size` are pending, or earlier when no new update arrived for `flush_interval` seconds.
+    Updates that would leave the transaction in its current category are not written at all.
+    """
+
+    def __init__(self, chunk_size=UPDATE_CHUNK_SIZE, flush_interval=UPDATE_FLUSH_INTERVAL, stats=None, category_uuids=None, journal=None):
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.category_uuids = category_uuids
+        self.journal = journal
+        self.stats = stats or PipelineStats()
+        self.results = {}
+        self.unchanged = set()
+        # Bounded, so a slow MoneyMoney holds back the categorization instead of piling up updates.
+        self.queue = queue.Queue(maxsize=UPDATE_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._run, name="moneymoney-updater", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, transaction_id, category, current_category=None):
+        """
+        Queues an update. If `category` (compared by UUID when `category_uuids` are known) equals
+        `current_category`, the write is skipped and the transaction is recorded in `unchanged` instead.
+        """
+        target = self.category_uuids.get(category) if self.category_uuids else category
+        if target is not None and target == current_category:
+            self.unchanged.add(transaction_id)
+            return
+        start = time.monotonic()
+        self.queue.put((transaction_id, category))
+        self.stats.add_blocked("categorize", time.monotonic() - start)
+
+    def close(self):
+        """
+        Writes everything still pending, stops the thread and returns the id -> success map of all updates.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        return self.results
+
+    def _run(self):
+        pending = {}
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval if pending else None)
+            except queue.Empty:
+                pending = self._flush(pending)
+                continue
+            if item is None:
+                break
+            pending[item[0]] = item[1]
+            if len(pending) >= self.chunk_size:
+                pending = self._flush(pending)
+        self._flush(pending)
+
+    def _flush(self, pending):
+        if pending:
+            try:
+                with self.stats.busy("update"):
+                    results = update_transactions_in_moneymoney_bulk(pending, self.chunk_size, self.category_uuids)
+                self.results.update(results)
+            except Exception as e:
+                print(f"❌ ERROR: Writing {len(pending)} updates to MoneyMoney failed. Error: {e}")
+                self.results.update({transaction_id: False for transaction_id in pending})
+            else:
+                written = {transaction_id: pending[transaction_id] for transaction_id, succeeded in results.items() if succeeded}
+                print(f"✍️ Wrote {len(written)} of {len(pending)} categories to MoneyMoney.")
+                if self.journal is not None:
+                    try:
+                        self.journal.record_applied(written)
+                    except OSError as e:
+                        # The updates are written either way; only a resumed run would write them again.
+                        print(f"⚠️ WARNING: Could not journal {len(written)} applied updates. Error: {e}")
+        return {}
 
 # --- SCRIPT EXECUTION ---
-if __name__ == "__main__":
-    ai_client = None
-    # Initialize the correct client based on the provider
-    if AI_PROVIDER == "openai":
-        if not os.getenv("OPENAI_API_KEY"):
-            print("❌ FATAL ERROR: AI_PROVIDER is 'openai' but OPENAI_API_KEY environment variable is not set.")
-            exit(1)
-        ai_client = OpenAI()
-    
-    elif AI_PROVIDER == "anthropic":
-        if not os.getenv("ANTHROPIC_API_KEY"):
-            print("❌ FATAL ERROR: AI_PROVIDER is 'anthropic' but ANTHROPIC_API_KEY environment variable is not set.")
-            exit(1)
-        ai_client = anthropic.Anthropic()
-    
-    elif AI_PROVIDER == "deepseek":
-        api_key = os.getenv("DEEPSEEK_API_KEY")
-        if not api_key:
-            print("❌ FATAL ERROR: AI_PROVIDER is 'deepseek' but DEEPSEEK_API_KEY environment variable is not set.")
-            exit(1)
-        # Use the OpenAI client, but configure it for the DeepSeek API endpoint.
-        ai_client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com/v1")
-    
-    else:
-        print(f"❌ FATAL ERROR: Unknown AI_PROVIDER '{AI_PROVIDER}'. Please choose 'openai', 'anthropic', or 'deepseek'.")
-        exit(1)
-        
-    exported_data = export_transactions_from_moneymoney(UNCATGEGORIZED_CATEGORY_UUID)
-
-    if exported_data:
-        all_transactions = exported_data.get('transactions', [])
-        print(f"\n--- 📋 Export Report: Found {len(all_transactions)} total transactions to categorize ---")
-        for trx in all_transactions:
-            date_str = trx.get('bookingDate', datetime.datetime.now()).strftime('%Y-%m-%d')
+
+def run(provider, category_cache, run_state, classifier=None, rules=None, category_tree=None, journal=None):
+    """
+    Runs one export -> categorize -> update pass. `run_state` is advanced in place but not saved.
+    Transactions are streamed from the export into the AI batches, so only their IDs, fingerprints and
+    booking dates are kept in memory. With a `category_tree`, categories are written by UUID. With a
+    `journal`, AI answers and applied updates are journaled, and those of an interrupted run are reused.
+    Returns a summary dict, or None if the export failed.
+    """
+    uncategorized_uuid = category_tree.uncategorized_uuid if category_tree else UNCATGEGORIZED_CATEGORY_UUID
+    transactions = export_transactions_from_moneymoney(uncategorized_uuid, export_start_date(run_state))
+    if transactions is None:
+        return None
+
+    counts = {"exported": 0, "booked": 0, "skipped": 0, "journal": 0, "rules": 0, "cache": 0, "nearest_neighbor": 0}
+    updated_transactions_map = {}
+    booking_dates = {}
+    current_categories = {}
+    fingerprints_sent_to_ai = {}
+    already_written = set()
+    stats = PipelineStats()
+    updater = UpdateWorker(stats=stats, category_uuids=category_tree.uuids if category_tree else None, journal=journal)
+    if journal:
+        print(f"♻️ Resuming an interrupted run: {len(journal.decisions)} journaled AI answers, {len(journal.applied)} updates already written.")
+
+    def resolve(trx_id, category):
+        updated_transactions_map[trx_id] = category
+        updater.submit(trx_id, category, current_categories.get(trx_id))
+
+    def journal_decisions(id_to_category_map):
+        try:
+            journal.record_decisions(id_to_category_map)
+        except OSError as e:
+            print(f"⚠️ WARNING: Could not journal {len(id_to_category_map)} AI answers. Error: {e}")
+
+    def on_ai_result(trx_id, category):
+        # Ids the model made up are ignored, and so are repeats from a batch that is retried after its
+        # stream failed partway, since those transactions were already handed to the updater.
+        if trx_id in fingerprints_sent_to_ai and trx_id not in updated_transactions_map:
+            resolve(trx_id, category)
+
+    def classify_or_pass_on(pending):
+        """
+        Runs the nearest-neighbor classifier over a group of cache misses and yields those it cannot resolve.
+        """
+        predictions = classifier.predict([fingerprint for _, fingerprint in pending]) if classifier else [(None, 0.0)] * len(pending)
+        for (trx, fingerprint), (category, _) in zip(pending, predictions):
+            if category:
+                resolve(trx['id'], category)
+                counts["nearest_neighbor"] += 1
+            else:
+                fingerprints_sent_to_ai[trx['id']] = fingerprint
+                yield trx
+
+    def transactions_for_ai():
+        """
+        Prints the export report while streaming, resolves what it can with the rules, the cache and the
+        nearest-neighbor classifier, and yields the rest.
+        """
+        pending = []
+        for trx in prefetch(transactions, "export", stats):
+            counts["exported"] += 1
+            date_str = _booking_date(trx).strftime('%Y-%m-%d')
             name = trx.get('name', 'N/A')
             amount = trx.get('amount', 0.0)
             currency = trx.get('currency', '')
             print(f"- {date_str}: {name} ({amount:.2f} {currency})")
-        print("----------------------------------------------------")
-
-        print("\n👉 Step 2: Processing all exported transactions...")
-        transactions_to_categorize = [trx for trx in all_transactions if trx.get('booked')]
-        updated_transactions_map = {}
-        if transactions_to_categorize:
-            updated_transactions_map = get_ai_categories_batch(ai_client, AI_PROVIDER, transactions_to_categorize)
-            print(f"✅ AI successfully categorized {len(updated_transactions_map)} transactions.")
-        else:
-            print("No booked transactions found to process.")
 
-        print(f"\n👉 Step 3: Updating {len(updated_transactions_map)} transactions in MoneyMoney...")
-        if not updated_transactions_map:
-            print("No transactions needed updating.")
+            if not trx.get('booked'):
+                continue
+            if str(trx['id']) in run_state["processed_ids"]:
+                counts["skipped"] += 1
+                continue
+            counts["booked"] += 1
+            booking_dates[trx['id']] = _booking_date(trx)
+            current_categories[trx['id']] = _current_category(trx, category_tree)
+
+            if journal is not None and trx['id'] in journal.applied:
+                updated_transactions_map[trx['id']] = journal.applied[trx['id']]
+                already_written.add(trx['id'])
+                counts["journal"] += 1
+                continue
+            if journal is not None and trx['id'] in journal.decisions:
+                resolve(trx['id'], journal.decisions[trx['id']])
+                counts["journal"] += 1
+                continue
+
+            rule_category = rules.match(trx) if rules else None
+            if rule_category:
+                resolve(trx['id'], rule_category)
+                counts["rules"] += 1
+                continue
+
+            fingerprint = transaction_fingerprint(trx)
+            cached_category = category_cache.lookup(fingerprint)
+            if cached_category:
+                resolve(trx['id'], cached_category)
+                counts["cache"] += 1
+                continue
+            pending.append((trx, fingerprint))
+            if len(pending) >= NN_BATCH_SIZE:
+                yield from classify_or_pass_on(pending)
+                pending = []
+        yield from classify_or_pass_on(pending)
+
+    print("\n--- 📋 Export Report ---")
+    print("\n👉 Step 2: Categorizing exported transactions as they are parsed...")
+    print("👉 Step 3: Writing categories to MoneyMoney in the background as they arrive...")
+    updater.start()
+    try:
+        ai_categories = get_ai_categories_chunked(provider, transactions_for_ai(), on_result=on_ai_result, stats=stats,
+                                                  on_batch=journal_decisions if journal is not None else None)
+    finally:
+        print("Waiting for the remaining MoneyMoney updates...")
+        update_results = updater.close()
+    unchanged_ids = updater.unchanged - update_results.keys()
+    print("----------------------------------------------------")
+    if counts["skipped"]:
+        print(f"⏭️ Skipped {counts['skipped']} transactions already handled in a previous run.")
+    if counts["journal"]:
+        print(f"♻️ Journal of the interrupted run resolved {counts['journal']} transactions without new AI calls.")
+    if rules:
+        print(f"📏 Rules resolved {counts['rules']} transactions.")
+    if counts["booked"]:
+        print(f"🗄️ Cache resolved {counts['cache']} of {counts['booked']} transactions.")
+    if classifier:
+        print(f"🧭 Nearest-neighbor classifier resolved {counts['nearest_neighbor']} transactions.")
+    if fingerprints_sent_to_ai:
+        print(f"✅ AI successfully categorized {len(ai_categories)} transactions.")
+        for trx_id, category in ai_categories.items():
+            if trx_id not in fingerprints_sent_to_ai:
+                continue
+            # "Uncategorized" is not cached so that the transaction gets another chance next run.
+            if category != "Uncategorized":
+                category_cache.store(fingerprints_sent_to_ai[trx_id], category)
+        category_cache.commit()
+    elif not counts["booked"]:
+        print("No booked transactions found to process.")
+
+    if unchanged_ids:
+        print(f"⏭️ Skipped writing {len(unchanged_ids)} transactions whose category would not change.")
+    if not update_results:
+        print("No transactions needed updating.")
+    else:
+        failed_count = sum(1 for succeeded in update_results.values() if not succeeded)
+        if failed_count:
+            print(f"⚠️ {failed_count} of {len(update_results)} transactions could not be updated.")
         else:
-            for trx_id, new_category in updated_transactions_map.items():
-                update_transaction_in_moneymoney(trx_id, new_category)
-            print("✅ All targeted transactions updated successfully!")
-        
-        print("\n--- 📊 Final Summary ---")
-        print(f"Total Transactions Exported: {len(all_transactions)}")
-        print(f"Total Transactions Updated: {len(updated_transactions_map)}")
-        print("-------------------------")
-        print("All done! 🎉")
\ No newline at end of file
+            print(f"✅ All {len(update_results)} targeted transactions updated successfully!")
+
+    handled, unhandled = [], []
+    for trx_id, booking_date in booking_dates.items():
+        succeeded = update_results.get(trx_id) or trx_id in unchanged_ids or trx_id in already_written
+        (handled if succeeded else unhandled).append((trx_id, booking_date))
+    # A failed export holds the high-water mark at its start, so its transactions are exported again next run.
+    unhandled += [(None, job["from_date"]) for job in getattr(transactions, "failed_jobs", [])]
+    advance_run_state(run_state, handled, unhandled)
+
+    updated_count = sum(1 for succeeded in update_results.values() if succeeded)
+    ai_categorized = sum(1 for trx_id in fingerprints_sent_to_ai if trx_id in updated_transactions_map)
+    for name, value in (
+        ("transactions_exported", counts["exported"]),
+        ("transactions_skipped", counts["skipped"]),
+        ("transactions_resolved_by_journal", counts["journal"]),
+        ("transactions_resolved_by_rules", counts["rules"]),
+        ("transactions_resolved_by_cache", counts["cache"]),
+        ("transactions_resolved_by_nearest_neighbor", counts["nearest_neighbor"]),
+        ("transactions_sent_to_ai", len(fingerprints_sent_to_ai)),
+        ("transactions_categorized_by_ai", ai_categorized),
+        ("transactions_updated", updated_count),
+        ("transactions_unchanged", len(unchanged_ids)),
+        ("transactions_update_failed", len(update_results) - updated_count),
+        ("cache_hit_rate", category_cache.hit_rate),
+        ("rule_hit_rate", counts["rules"] / counts["booked"] if counts["booked"] else 0.0),
+    ):
+        METRICS.set_gauge(name, value)
+    for token_type, value in provider.usage.items():
+        METRICS.set_gauge(f"ai_{token_type}", value, provider=provider.name)
+    for stage, busy_seconds in stats.busy_seconds.items():
+        METRICS.set_gauge("stage_busy_seconds", busy_seconds, stage=stage)
+
+    print("\n--- 📊 Final Summary ---")
+    print(f"Total Transactions Exported: {counts['exported']}")
+    print(f"Skipped (Already Processed): {counts['skipped']}")
+    print(f"Total Transactions Updated: {updated_count}")
+    print(f"Unchanged (Write Skipped): {len(unchanged_ids)}")
+    print(f"Cache Hit Rate: {category_cache.hit_rate:.0%} ({category_cache.hits} hits, {category_cache.misses} misses)")
+    print(f"Resolved from Journal: {counts['journal']}")
+    print(f"Resolved by Rules: {counts['rules']}")
+    print(f"Resolved by Nearest Neighbor: {counts['nearest_neighbor']}")
+    print(f"Resolved by AI: {len(fingerprints_sent_to_ai)} sent, {ai_categorized} categorized")
+    print(f"AI Tokens: {provider.usage_summary()}")
+    latency = METRICS.summaries().get(("api_latency_seconds", (("provider", provider.name),)))
+    if latency:
+        print(f"AI Latency: p50 {latency['p50']:.1f}s, p90 {latency['p90']:.1f}s, p99 {latency['p99']:.1f}s over {latency['count']} requests")
+    stats.report()
+    print("-------------------------")
+    print("All done! 🎉")
+    return {
+        "exported": counts["exported"],
+        "skipped": counts["skipped"],
+        "categorized": len(updated_transactions_map),
+        "rules": counts["rules"],
+        "updated": updated_count,
+        "unchanged": len(unchanged_ids),
+        "failed": len(update_results) - updated_count,
+    }
+
+def export_history(category_cache):
+    """
+    Exports the categorized history, saves it as a snapshot and seeds the category cache with it.
+    """
+    if numpy is None:
+        print("❌ FATAL ERROR: The history snapshot requires NumPy. Install it with `pip3 install numpy`.")
+        exit(1)
+    records = list(export_history_from_moneymoney())
+    for _, _, fingerprint, category in sorted(records, key=lambda record: record[1]):
+        category_cache.store(fingerprint, category)
+    category_cache.commit()
+    save_history_snapshot(records)
+    print(f"✅ Saved {len(records)} categorized transactions to {HISTORY_PATH} and seeded the cache.")
+
+def _main(args):
+    if args.export_history:
+        category_cache = CategoryCache()
+        try:
+            export_history(category_cache)
+        finally:
+            category_cache.close()
+        return
+
+    try:
+        ai_provider = create_provider(AI_PROVIDER)
+    except ProviderConfigurationError as e:
+        print(f"❌ FATAL ERROR: {e}")
+        exit(1)
+
+    category_tree = load_category_tree(refresh=args.refresh_categories)
+    if category_tree:
+        # Replaced in place, so everything that reads AVAILABLE_CATEGORIES sees the real categories.
+        AVAILABLE_CATEGORIES[:] = category_tree.names()
+        print(f"🗂️ Using {len(AVAILABLE_CATEGORIES)} categories from MoneyMoney's category tree.")
+    print(build_system_prompt())
+
+    try:
+        rules = load_rules()
+    except (OSError, ValueError) as e:
+        print(f"❌ FATAL ERROR: Could not load category rules from {RULES_PATH}. Error: {e}")
+        exit(1)
+
+    run_state = load_run_state()
+    category_cache = CategoryCache()
+    journal = RunJournal()
+    try:
+        classifier = build_classifier(category_cache, load_history_snapshot())
+        summary = run(ai_provider, category_cache, run_state, classifier, rules, category_tree, journal)
+        if summary is not None:
+            save_run_state(run_state)
+            journal.clear()
+            if category_tree and summary["failed"]:
+                # Failed writes may mean categories were renamed or deleted: export the tree again next run.
+                invalidate_category_tree()
+    finally:
+        journal.close()
+        category_cache.close()
+        if METRICS_PATH:
+            try:
+                METRICS.write()
+            except (OSError, ValueError) as e:
+                print(f"⚠️ WARNING: Could not write metrics to {METRICS_PATH}. Error: {e}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Categorize uncategorized MoneyMoney transactions with AI.")
+    parser.add_argument("--export-history", action="store_true", help="Export already categorized transactions to seed the cache and classifier, then exit.")
+    parser.add_argument("--refresh-categories", action="store_true", help="Export the category tree from MoneyMoney again instead of using the cached one.")
+    parser.add_argument("--profile", nargs="?", const="moneymoney_update_category.prof", metavar="PATH", help="Run under cProfile, print the slowest calls of the main thread and save the stats to PATH.")
+    args = parser.parse_args()
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(_main, args)
+        finally:
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+            print(f"📈 Saved profile to {args.profile} (inspect with `python3 -m pstats {args.profile}`).")
+        return
+    _main(args)
+
+if __name__ == "__main__":
+    main()
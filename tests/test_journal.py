@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+from moneymoney_update_category import RunJournal
+
+
+class RunJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "journal.jsonl")
+
+    def open_journal(self):
+        journal = RunJournal(self.path)
+        self.addCleanup(journal.close)
+        return journal
+
+    def test_records_survive_reopening(self):
+        journal = self.open_journal()
+        journal.record_decisions({1: "Auto", 2: "Tax"})
+        journal.record_applied({1: "Auto"})
+        journal.close()
+
+        reopened = self.open_journal()
+        self.assertEqual(reopened.decisions, {1: "Auto", 2: "Tax"})
+        self.assertEqual(reopened.applied, {1: "Auto"})
+
+    def test_torn_last_line_is_cut_off_before_appending(self):
+        journal = self.open_journal()
+        journal.record_decisions({1: "Auto"})
+        journal.close()
+        with open(self.path, "a") as f:
+            f.write('{"type":"appl')
+
+        resumed = self.open_journal()
+        self.assertEqual(resumed.decisions, {1: "Auto"})
+        resumed.record_decisions({4: "Pets", 5: "Tax", 6: "Travel & Transportation"})
+        resumed.close()
+
+        reopened = self.open_journal()
+        self.assertEqual(reopened.decisions, {1: "Auto", 4: "Pets", 5: "Tax", 6: "Travel & Transportation"})
+        with open(self.path) as f:
+            self.assertNotIn('"appl{', f.read())
+
+    def test_clear_empties_the_journal(self):
+        journal = self.open_journal()
+        journal.record_decisions({1: "Auto"})
+        journal.clear()
+        journal.close()
+
+        self.assertFalse(self.open_journal())
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+from moneymoney_update_category import RuleEngine, _KeywordAutomaton
+
+
+def transaction(name="", purpose="", amount=-10.0):
+    return {"name": name, "purpose": purpose, "amount": amount}
+
+
+class KeywordAutomatonTest(unittest.TestCase):
+
+    def build(self, *keywords):
+        automaton = _KeywordAutomaton()
+        for index, keyword in enumerate(keywords):
+            automaton.add(keyword, index)
+        automaton.build()
+        return automaton
+
+    def test_finds_every_occurrence_with_positions(self):
+        automaton = self.build("he", "she", "his", "hers")
+        self.assertEqual(sorted(automaton.search("ushers")), [(1, 4, 1), (2, 4, 0), (2, 6, 3)])
+
+    def test_follows_failure_links_into_overlapping_keywords(self):
+        automaton = self.build("abcd", "bc", "c")
+        self.assertEqual(sorted(automaton.search("abce")), [(1, 3, 1), (2, 3, 2)])
+
+    def test_no_match(self):
+        automaton = self.build("rewe", "edeka")
+        self.assertEqual(list(automaton.search("aldi sued")), [])
+
+
+class RuleEngineTest(unittest.TestCase):
+
+    def test_keyword_rules_match_their_field_case_insensitively(self):
+        engine = RuleEngine([
+            {"category": "Groceries", "name": "REWE|edeka"},
+            {"category": "Rent", "purpose": "miete"},
+        ])
+        self.assertEqual(engine.match(transaction(name="Edeka Center")), "Groceries")
+        self.assertEqual(engine.match(transaction(purpose="Miete Januar")), "Rent")
+        self.assertIsNone(engine.match(transaction(name="Miete GmbH")))
+        self.assertIsNone(engine.match(transaction(purpose="rewe")))
+
+    def test_pattern_rules_search_both_fields(self):
+        engine = RuleEngine([{"category": "Travel", "pattern": "bahn"}])
+        self.assertEqual(engine.match(transaction(name="Deutsche Bahn")), "Travel")
+        self.assertEqual(engine.match(transaction(purpose="BahnCard")), "Travel")
+
+    def test_anchors_apply_to_the_rule_field(self):
+        engine = RuleEngine([
+            {"category": "Rent", "purpose": "^miete"},
+            {"category": "Tax", "name": "amt$"},
+        ])
+        self.assertEqual(engine.match(transaction(name="Vermieter", purpose="Miete Januar")), "Rent")
+        self.assertEqual(engine.match(transaction(name="Finanzamt", purpose="Steuer")), "Tax")
+        self.assertIsNone(engine.match(transaction(name="Vermieter", purpose="Nebenkosten Miete")))
+
+    def test_regex_does_not_cross_from_name_into_purpose(self):
+        engine = RuleEngine([{"category": "Tax", "name": "amt.*steuer"}])
+        self.assertIsNone(engine.match(transaction(name="Finanzamt", purpose="Steuer 2025")))
+        self.assertEqual(engine.match(transaction(name="Finanzamt Einkommensteuer")), "Tax")
+
+    def test_backreferences_named_groups_and_inline_flags(self):
+        engine = RuleEngine([
+            {"category": "Doubles", "name": r"(\w)\1"},
+            {"category": "Named", "purpose": r"(?P<ref>\d+)-(?P=ref)"},
+            {"category": "Inline", "pattern": r"(?i)netfl(?P<ref>i)x"},
+        ])
+        self.assertEqual(engine.match(transaction(name="hello")), "Doubles")
+        self.assertEqual(engine.match(transaction(name="abc", purpose="Ref 42-42")), "Named")
+        self.assertEqual(engine.match(transaction(name="NETFLIX")), "Inline")
+
+    def test_first_rule_in_file_order_wins_across_keywords_and_regexes(self):
+        engine = RuleEngine([
+            {"category": "Regex first", "name": "^shell"},
+            {"category": "Keyword", "name": "shell"},
+            {"category": "Regex last", "name": "tank.*"},
+        ])
+        self.assertEqual(engine.match(transaction(name="Shell Tankstelle")), "Regex first")
+        self.assertEqual(engine.match(transaction(name="Esso Shell Tankstelle")), "Keyword")
+        self.assertEqual(engine.match(transaction(name="Aral Tankstelle")), "Regex last")
+
+    def test_amount_conditions_fall_through_to_later_rules(self):
+        engine = RuleEngine([
+            {"category": "Big Amazon", "name": "amaz.n", "max_amount": -100},
+            {"category": "Small Amazon", "name": "amazon"},
+            {"category": "Refund", "name": "amaz.n", "min_amount": 0},
+        ])
+        self.assertEqual(engine.match(transaction(name="Amazon EU", amount=-250.0)), "Big Amazon")
+        self.assertEqual(engine.match(transaction(name="Amazon EU", amount=-20.0)), "Small Amazon")
+        self.assertEqual(engine.match(transaction(name="Amazon EU", amount=None)), "Small Amazon")
+
+    def test_invalid_rules_raise_value_error(self):
+        with self.assertRaises(ValueError):
+            RuleEngine([{"category": "Broken", "name": "(unclosed"}])
+        with self.assertRaises(ValueError):
+            RuleEngine([{"category": "Two fields", "name": "a", "purpose": "b"}])
+        with self.assertRaises(ValueError):
+            RuleEngine([{"name": "no category"}])
+
+
+if __name__ == "__main__":
+    unittest.main()